@@ -0,0 +1,216 @@
+"""Benchmarks of the rendering of adgeletti's template tags.
+
+Each scenario creates a synthetic site configuration, with a number of slots,
+each having a position for each of a number of breakpoints, each allowing a
+number of sizes. A template using ``{% ad ... %}`` for every slot and
+breakpoint, followed by ``{% adgeletti_go %}``, is then rendered repeatedly,
+measuring the latency of each render, the number of queries run and the number
+of bytes allocated (see ``measure_allocations``).
+
+Scenarios are run with and without ``settings.ADGELETTI_CONFIG_CACHE``, and
+the first (cold) render of each is reported separately from the others. See
+the ``adgeletti_benchmark`` management command, which runs them against a test
+database and a private cache (see ``private_cache``), and outputs their
+results as JSON.
+"""
+import gc
+import math
+import sys
+import time
+from contextlib import contextmanager
+
+import django
+from django import template
+from django.contrib.sites.models import Site
+from django.core.cache import get_cache
+from django.db import connection
+from django.test.utils import override_settings
+
+from adgeletti import VERSION
+from adgeletti import cache
+from adgeletti.models import Size, AdSlot, AdPosition, AdPositionLookup
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class BenchmarkRequest(object):
+    """Stands in for the request in the context of rendered templates, so that
+    they are rendered for the benchmark's site.
+    """
+    def __init__(self, site):
+        self.site = site
+
+
+@contextmanager
+def private_cache():
+    """Has ``adgeletti.cache`` use a cache private to this process for the
+    block of a ``with`` statement, so that benchmarks don't bump the
+    generation of (or store their configurations in) the project's cache,
+    which live processes share. This process' snapshots and payloads are
+    discarded before and after.
+    """
+    shared = cache.django_cache
+    cache.django_cache = get_cache('django.core.cache.backends.locmem.LocMemCache', LOCATION='adgeletti-benchmarks')
+    cache._snapshots.clear()
+    cache.payloads.clear()
+    try:
+        yield
+    finally:
+        cache.django_cache = shared
+        cache._snapshots.clear()
+        cache.payloads.clear()
+
+
+def percentile(values, percent):
+    """Returns the given percentile of a list of values, using the
+    nearest-rank method.
+    """
+    values = sorted(values)
+    rank = int(math.ceil(percent / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def create_config(slots, breakpoints, sizes):
+    """Creates a site with the given numbers of slots, each having a position
+    for the given number of breakpoints, each allowing the given number of
+    sizes. Returns the site, and the source of a template for a page
+    displaying each slot for each breakpoint.
+    """
+    site = Site.objects.create(name='Benchmark', domain='benchmark.example.com')
+    breakpoint_names = ['bp%d' % i for i in range(breakpoints)]
+
+    size_objs = []
+    for i in range(sizes):
+        size, created = Size.objects.get_or_create(width=300 + i, height=250)
+        size_objs.append(size)
+
+    AdSlot.objects.bulk_create([AdSlot(label='slot%d' % i, site=site, ad_unit='unit/%d' % i) for i in range(slots)])
+    slot_objs = list(AdSlot.objects.filter(site=site))
+
+    AdPosition.objects.bulk_create([AdPosition(slot=slot, breakpoint=bp) for slot in slot_objs for bp in breakpoint_names])
+    Through = AdPosition.sizes.through
+    Through.objects.bulk_create([
+        Through(adposition_id=pos_id, size_id=size.pk)
+        for pos_id in AdPosition.objects.filter(slot__site=site).values_list('pk', flat=True)
+        for size in size_objs
+    ])
+    AdPositionLookup.objects.refresh(AdPosition.objects.filter(slot__site=site))
+    cache.bump_generation()
+
+    tags = ''.join('{%% ad %s %s %%}\n' % (slot.label, ' '.join(breakpoint_names)) for slot in slot_objs)
+    return site, '{% load adgeletti_tags %}\n' + tags + '{% adgeletti_go %}\n'
+
+
+def measure(tpl, site):
+    """Renders the template once, returning the number of seconds it took, the
+    number of queries run, and the output.
+    """
+    queries = len(connection.queries)
+    context = template.Context({'request': BenchmarkRequest(site)})
+    start = time.time()
+    output = tpl.render(context)
+    elapsed = time.time() - start
+    return elapsed, len(connection.queries) - queries, output
+
+
+def measure_allocations(tpl, site):
+    """Returns the number of bytes allocated while rendering the template
+    once, and how it was measured: the peak traced by ``tracemalloc``, where
+    available, or else (on Python 2) a census of the objects created by the
+    render, as described in ``census_allocations``.
+    """
+    context = template.Context({'request': BenchmarkRequest(site)})
+    if tracemalloc is None:
+        return census_allocations(tpl, context), 'census'
+    tracemalloc.start()
+    try:
+        tpl.render(context)
+        return tracemalloc.get_traced_memory()[1], 'tracemalloc'
+    finally:
+        tracemalloc.stop()
+
+
+def census_allocations(tpl, context):
+    """Returns the total size of the output of rendering the template, and of
+    the objects tracked by the garbage collector (e.g., lists, dicts and
+    instances) that the render created and that are still alive at its end.
+    The collector is disabled meanwhile, so that this includes the garbage
+    cycles it created. Objects freed during the render aren't included, so
+    this is a lower bound of the bytes allocated.
+    """
+    gc.collect()
+    gc.disable()
+    try:
+        before = set(id(obj) for obj in gc.get_objects())
+        before.add(id(before))
+        output = tpl.render(context)
+        created = sum(sys.getsizeof(obj) for obj in gc.get_objects() if id(obj) not in before)
+        return sys.getsizeof(output) + created
+    finally:
+        gc.enable()
+
+
+def run_scenario(slots, breakpoints, sizes, iterations, cached=True):
+    """Runs a scenario (see ``create_config``), returning its results as a
+    dictionary.
+    """
+    site, source = create_config(slots, breakpoints, sizes)
+    tpl = template.Template(source)
+
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    try:
+        with override_settings(ADGELETTI_CONFIG_CACHE=cached):
+            cold, cold_queries, output = measure(tpl, site)
+            latencies, queries = [], 0
+            for i in range(iterations):
+                elapsed, count, output = measure(tpl, site)
+                latencies.append(elapsed)
+                queries += count
+            allocated, allocation_method = measure_allocations(tpl, site)
+    finally:
+        connection.use_debug_cursor = old_debug_cursor
+
+    return {
+        'slots': slots,
+        'breakpoints': breakpoints,
+        'sizes': sizes,
+        'cached': cached,
+        'iterations': iterations,
+        'latency_ms': {
+            'cold': cold * 1000,
+            'p50': percentile(latencies, 50) * 1000,
+            'p90': percentile(latencies, 90) * 1000,
+            'p99': percentile(latencies, 99) * 1000,
+            'max': max(latencies) * 1000,
+        },
+        'queries': {
+            'cold': cold_queries,
+            'mean': float(queries) / iterations,
+        },
+        'allocated_bytes': allocated,
+        'allocation_method': allocation_method,
+        'output_bytes': len(output.encode('utf-8')),
+    }
+
+
+def run(slots=(1, 10, 100, 500), breakpoints=(1, 3, 10), sizes=(1, 4), iterations=100):
+    """Runs every combination of the given numbers of slots, breakpoints and
+    sizes as a scenario, with and without caching, returning their results as
+    a dictionary.
+    """
+    results = []
+    for slot_count in slots:
+        for breakpoint_count in breakpoints:
+            for size_count in sizes:
+                for cached in (True, False):
+                    results.append(run_scenario(slot_count, breakpoint_count, size_count, iterations, cached))
+
+    return {
+        'adgeletti': '.'.join(str(v) for v in VERSION),
+        'django': django.get_version(),
+        'results': results,
+    }
@@ -0,0 +1,389 @@
+"""Caching of the ad configuration of each site.
+
+The configuration of a site is a dictionary of slot labels, each mapping the
+slot's breakpoints to the data of its position for that breakpoint:
+
+    {'AD-01': {'Mobile': {'ad_unit_id': '0123456789/unit', 'sizes': [[320, 50]]}}}
+
+Positions that are refreshed periodically also have a "refresh" key, holding
+an [interval, max_refreshes] pair (see ``AdRefresh``).
+
+A snapshot of each site's configuration is kept in memory, stamped with the
+generation of the configuration it was built from. The generation is a value
+kept in Django's cache, and is replaced whenever an ``AdSlot``, ``AdPosition``
+or ``Size`` changes (see ``invalidate``), so that every process sharing that
+cache can tell whether its snapshots are stale with a single cache read.
+
+If ``settings.ADGELETTI_SHARED_CONFIG_CACHE`` is ``True``, configurations are
+also stored in Django's cache, serialized as JSON and keyed by site and
+generation, so that a process with a stale snapshot can reload it from there
+rather than from the database. Only one process at a time builds a missing
+configuration; the others wait for it to be stored.
+
+The scripts rendered by ``{% adgeletti_go %}`` are also kept, in ``payloads``,
+keyed by generation, as they only depend on the configuration and the page.
+
+The configurations of every site can also be exported to a snapshot file (see
+``export_snapshot`` and the ``adgeletti_snapshot`` management command). If
+``settings.ADGELETTI_SNAPSHOT_FILE`` is set, each process loads its snapshots
+from that file when it starts (see ``load_snapshot_file``), without querying
+the database, as long as the generation it was exported at is still the
+current one. That requires a cache shared by the processes, as with a cache
+of their own, each process starts with a new generation.
+"""
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache as django_cache
+from django.db import transaction
+
+
+GENERATION_KEY = 'adgeletti:generation'
+CONFIG_KEY = 'adgeletti:config:%s:%s'
+
+# Number of seconds a process may hold the lock for building a configuration,
+# and number of seconds between checks by processes waiting on it
+LOCK_TIMEOUT = 5
+LOCK_WAIT = 0.05
+
+# Version of the format of snapshot files
+SNAPSHOT_VERSION = 1
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    """Raised for invalid snapshot files.
+    """
+
+
+class LRUCache(object):
+    """A thread-safe cache, holding at most ``size`` values and discarding the
+    least recently used one to make room for new ones.
+    """
+    def __init__(self, size):
+        self.size = size
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self):
+        return len(self._links)
+
+    def clear(self):
+        """Discards all values.
+        """
+        with self._lock:
+            # Values are kept in a circular, doubly linked list of links of
+            # the form [previous, next, key, value], starting with the least
+            # recently used
+            self._links = {}
+            self._root = []
+            self._root[:] = [self._root, self._root, None, None]
+
+    def _unlink(self, link):
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+
+    def _append(self, link):
+        last = self._root[0]
+        link[0] = last
+        link[1] = self._root
+        last[1] = self._root[0] = link
+
+    def get(self, key, default=None):
+        """Returns the value for ``key``, or ``default`` if it isn't cached.
+        """
+        with self._lock:
+            link = self._links.get(key)
+            if link is None:
+                return default
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value):
+        """Caches ``value`` for ``key``.
+        """
+        with self._lock:
+            link = self._links.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+            elif len(self._links) >= self.size:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._links[oldest[2]]
+            link = [None, None, key, value]
+            self._append(link)
+            self._links[key] = link
+
+
+# Snapshots of site configurations, keyed by site ID, as (generation, config)
+_snapshots = {}
+
+# Scripts rendered by ``{% adgeletti_go %}``, keyed by site ID, generation and
+# the page's ads
+payloads = LRUCache(getattr(settings, 'ADGELETTI_PAYLOAD_CACHE_SIZE', 256))
+
+# Whether the configuration was changed in the current thread's transaction,
+# the generation being bumped once it's committed (see ``invalidate``)
+_pending = threading.local()
+
+
+def _seed():
+    """Returns a value for a new generation. This is based on the current
+    time, so that a generation that has been evicted from the cache is not
+    reused while a process may still have a snapshot for it, with random low
+    digits, so that concurrent bumps yield different values.
+    """
+    return int(time.time() * 1000) * 1000 + random.randrange(1000)
+
+
+def get_generation_timeout():
+    """Returns the number of seconds the generation is kept in Django's cache
+    (``settings.ADGELETTI_GENERATION_TIMEOUT``, a year by default). Backends'
+    default timeout (``None``) is usually a few minutes, after which a new
+    generation would be seeded, discarding every snapshot.
+    """
+    return getattr(settings, 'ADGELETTI_GENERATION_TIMEOUT', 365 * 24 * 60 * 60)
+
+
+def get_generation():
+    """Returns the current generation of the ad configuration.
+    """
+    generation = django_cache.get(GENERATION_KEY)
+    if generation is None:
+        django_cache.add(GENERATION_KEY, _seed(), get_generation_timeout())
+        generation = django_cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    """Replaces the generation of the ad configuration with a new one, causing
+    all snapshots of it to be considered stale.
+    """
+    # ``incr`` isn't used, as most backends reset the key's timeout to their
+    # default when incrementing it
+    current = django_cache.get(GENERATION_KEY)
+    generation = _seed()
+    while generation == current:
+        generation = _seed()
+    django_cache.set(GENERATION_KEY, generation, get_generation_timeout())
+
+
+def _add_position(config, pos):
+    data = config.setdefault(pos.label, {})[pos.breakpoint] = {
+        'ad_unit_id': pos.ad_unit_id(),
+        'sizes': pos.size_list(),
+    }
+    if pos.refresh_interval is not None:
+        data['refresh'] = pos.refresh_config()
+
+
+def build_config(site_id):
+    """Builds the configuration of a site from the database.
+    """
+    from adgeletti.models import AdPositionLookup
+
+    config = {}
+    for pos in AdPositionLookup.objects.for_site(site_id):
+        _add_position(config, pos)
+    return config
+
+
+def build_configs():
+    """Builds the configurations of every site from the database, returning
+    them as a dictionary keyed by site ID.
+    """
+    from django.contrib.sites.models import Site
+    from adgeletti.models import AdPositionLookup
+
+    configs = dict((site_id, {}) for site_id in Site.objects.values_list('pk', flat=True))
+    for pos in AdPositionLookup.objects.all():
+        _add_position(configs.setdefault(pos.site_id, {}), pos)
+    return configs
+
+
+def get_shared_config(site_id, generation):
+    """Returns the configuration of a site from Django's cache. If it is
+    missing, it is built and stored by this process, unless another process
+    holds the lock for building it, in which case this waits for it to be
+    stored (building it anyway if that takes longer than ``LOCK_TIMEOUT``).
+    """
+    key = CONFIG_KEY % (site_id, generation)
+    data = django_cache.get(key)
+    if data is not None:
+        return json.loads(data)
+
+    lock_key = key + ':lock'
+    if django_cache.add(lock_key, 1, LOCK_TIMEOUT):
+        try:
+            config = build_config(site_id)
+            django_cache.set(key, json.dumps(config), getattr(settings, 'ADGELETTI_SHARED_CONFIG_TIMEOUT', 86400))
+        finally:
+            django_cache.delete(lock_key)
+        return config
+
+    deadline = time.time() + LOCK_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(LOCK_WAIT)
+        data = django_cache.get(key)
+        if data is not None:
+            return json.loads(data)
+
+    return build_config(site_id)
+
+
+def checksum(configs):
+    """Returns a checksum of the given configurations, keyed by site ID. The
+    order of each position's sizes doesn't affect it.
+    """
+    normalized = dict(
+        (unicode(site_id), dict(
+            (label, dict((bp, dict(data, sizes=sorted(data['sizes']))) for bp, data in positions.items()))
+            for label, positions in config.items()
+        ))
+        for site_id, config in configs.items()
+    )
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def export_snapshot():
+    """Returns a snapshot of the configurations of every site, as a
+    dictionary of the snapshot format's version, the current generation, the
+    configurations (keyed by site ID) and their checksum.
+    """
+    # The generation is read first, so that changes made while building the
+    # configurations make the snapshot stale
+    generation = get_generation()
+    configs = build_configs()
+    return {
+        'version': SNAPSHOT_VERSION,
+        'generation': generation,
+        'checksum': checksum(configs),
+        'configs': configs,
+    }
+
+
+def write_snapshot(f, snapshot):
+    """Writes a snapshot (see ``export_snapshot``) to a file.
+    """
+    json.dump(snapshot, f, sort_keys=True, separators=(',', ':'))
+
+
+def read_snapshot(f):
+    """Reads a snapshot written by ``write_snapshot`` from a file, verifying
+    its checksum.
+    """
+    try:
+        snapshot = json.load(f)
+        if snapshot['version'] != SNAPSHOT_VERSION:
+            raise SnapshotError(u'Unsupported snapshot version: %r' % (snapshot['version'],))
+        snapshot['configs'] = dict((int(site_id), config) for site_id, config in snapshot['configs'].items())
+    except (KeyError, TypeError, ValueError, AttributeError) as exc:
+        raise SnapshotError(u'Invalid snapshot: %s' % exc)
+
+    if checksum(snapshot['configs']) != snapshot['checksum']:
+        raise SnapshotError(u'Invalid snapshot: checksum mismatch')
+    return snapshot
+
+
+def load_snapshot(snapshot):
+    """Installs the configurations of a snapshot (see ``read_snapshot``) as
+    this process' snapshots, unless the configuration has changed since it
+    was exported. Returns whether they were installed.
+    """
+    if snapshot['generation'] != get_generation():
+        return False
+    for site_id, config in snapshot['configs'].items():
+        _snapshots[site_id] = (snapshot['generation'], config)
+    return True
+
+
+_snapshot_file_loaded = False
+
+
+def load_snapshot_file():
+    """Loads the snapshot file in ``settings.ADGELETTI_SNAPSHOT_FILE``, if
+    any, once per process (when ``adgeletti.models`` is imported). Invalid and
+    stale snapshot files are ignored (the configuration being loaded as
+    usual), with a warning.
+    """
+    global _snapshot_file_loaded
+    if _snapshot_file_loaded:
+        return
+    _snapshot_file_loaded = True
+
+    path = getattr(settings, 'ADGELETTI_SNAPSHOT_FILE', None)
+    if not path:
+        return
+    try:
+        with open(path, 'rb') as f:
+            snapshot = read_snapshot(f)
+    except (IOError, SnapshotError) as exc:
+        logger.warning(u'Ignoring snapshot file %s: %s', path, exc)
+        return
+    if not load_snapshot(snapshot):
+        logger.warning(u'Ignoring snapshot file %s: the configuration has changed since it was exported', path)
+
+
+def get_config(site_id):
+    """Returns the configuration of a site, loading it only if there is no
+    snapshot of the current generation of it.
+    """
+    generation = get_generation()
+    snapshot = _snapshots.get(site_id)
+    if snapshot is not None and snapshot[0] == generation:
+        return snapshot[1]
+
+    if getattr(settings, 'ADGELETTI_SHARED_CONFIG_CACHE', False):
+        config = get_shared_config(site_id, generation)
+    else:
+        config = build_config(site_id)
+    _snapshots[site_id] = (generation, config)
+    return config
+
+
+def reset():
+    """Discards this process' snapshots and payloads, and bumps the
+    generation, causing every process to reload the configuration.
+    """
+    _snapshots.clear()
+    payloads.clear()
+    bump_generation()
+
+
+def invalidate(sender, **kwargs):
+    """Signal handler, discarding all snapshots when the ad configuration
+    changes.
+
+    Within a managed transaction (e.g., in the admin), bumping the generation
+    is delayed until the end of the request (see ``flush_invalidation``), so
+    that other processes don't reload the configuration before the change is
+    committed, and keep the old one as current.
+    """
+    if kwargs.get('action', 'post_').startswith('pre_'):
+        # ``m2m_changed`` is sent both before and after a change
+        return
+    if transaction.is_managed():
+        _snapshots.clear()
+        payloads.clear()
+        _pending.invalidated = True
+    else:
+        reset()
+
+
+def flush_invalidation(sender=None, **kwargs):
+    """Signal handler for ``request_finished``, bumping the generation if the
+    configuration was changed during the request, by which time its
+    transaction has been committed. Code changing the configuration in its
+    own managed transactions outside of requests should call it once they're
+    committed.
+    """
+    if getattr(_pending, 'invalidated', False):
+        _pending.invalidated = False
+        reset()
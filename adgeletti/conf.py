@@ -0,0 +1,31 @@
+"""Helpers for reading adgeletti's settings.
+"""
+from django.conf import settings
+
+
+def get_breakpoints():
+    """Returns the breakpoints in ``settings.ADGELETTI_BREAKPOINTS``, as a list
+    of (name, media query) pairs. Breakpoints may be given either by name only,
+    in which case their media query is ``None``, or as such a pair, e.g.:
+
+        ADGELETTI_BREAKPOINTS = (
+            (u'Mobile', u'(max-width: 767px)'),
+            (u'Tablet', u'(min-width: 768px) and (max-width: 1023px)'),
+            u'Print',
+        )
+    """
+    breakpoints = []
+    for breakpoint in settings.ADGELETTI_BREAKPOINTS:
+        if isinstance(breakpoint, basestring):
+            breakpoints.append((breakpoint, None))
+        else:
+            name, media_query = breakpoint
+            breakpoints.append((name, media_query))
+    return breakpoints
+
+
+def get_media_queries():
+    """Returns a dictionary of the media queries of the breakpoints that have
+    one, keyed by breakpoint name.
+    """
+    return dict((name, media_query) for name, media_query in get_breakpoints() if media_query)
@@ -0,0 +1,129 @@
+"""Server-side pruning of the breakpoints that can't apply to a request.
+
+If ``settings.ADGELETTI_PRUNE_BREAKPOINTS`` is ``True``, ``{% ad ... %}``
+skips the breakpoints whose media queries can't match the requesting device's
+viewport, so that neither their divs nor their positions are output. The
+viewport's width is estimated from, in order of preference:
+
+    - the ``Sec-CH-Viewport-Width`` (or ``Viewport-Width``) client hint
+    - the ``Sec-CH-UA-Mobile`` client hint, when it indicates a mobile device
+    - a classification of the User-Agent header, by the function whose dotted
+      path is in ``settings.ADGELETTI_DEVICE_CLASSIFIER`` (by default,
+      ``classify_user_agent``), memoized for each User-Agent
+
+Only media queries made of ``min-width`` and ``max-width`` conditions (in px or
+em) are evaluated. Breakpoints without one, or with other conditions, are
+always kept, as are all breakpoints when the viewport can't be estimated.
+"""
+import re
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from adgeletti.cache import LRUCache
+from adgeletti.conf import get_breakpoints
+
+
+# The range of viewport widths assumed for mobile devices (including phones
+# in landscape), in pixels
+MOBILE_WIDTHS = (0, 959)
+
+# Width conditions of media queries, and their optional media type prefix
+_width = re.compile(r'^\(\s*(min|max)-width\s*:\s*(\d+(?:\.\d+)?)(px|r?em)\s*\)$')
+_media_type = re.compile(r'^(only\s+)?(screen|all)\s+and\s+', re.IGNORECASE)
+
+# Widths classified for each User-Agent (see ``classify``)
+_classified = LRUCache(1024)
+
+
+def parse_widths(media_query):
+    """Returns the range of viewport widths, in pixels, for which the given
+    media query matches, as a (min, max) pair (either of which may be
+    ``None``), or ``None`` if the media query can't be evaluated.
+    """
+    query = _media_type.sub(u'', media_query.strip()).lower()
+    widths = [None, None]
+    for condition in query.split(u' and '):
+        match = _width.match(condition.strip())
+        if match is None:
+            return None
+        kind, value, unit = match.groups()
+        value = float(value) * (1 if unit == 'px' else 16)
+        widths[0 if kind == 'min' else 1] = value
+    return tuple(widths)
+
+
+def classify_user_agent(user_agent):
+    """The default device classifier, returning ``MOBILE_WIDTHS`` for phones
+    (whose User-Agents have a "Mobi" token, as recommended to browser vendors),
+    and ``None`` for other devices, whose viewports may have any width.
+    """
+    if u'Mobi' in user_agent and u'iPad' not in user_agent:
+        return MOBILE_WIDTHS
+    return None
+
+
+def get_classifier():
+    """Returns the device classifier set in
+    ``settings.ADGELETTI_DEVICE_CLASSIFIER``, a function taking a User-Agent
+    and returning the range of viewport widths of devices using it, as a (min,
+    max) pair, or ``None`` if unsure.
+    """
+    path = getattr(settings, 'ADGELETTI_DEVICE_CLASSIFIER', None)
+    if not path:
+        return classify_user_agent
+    module, name = path.rsplit('.', 1)
+    return getattr(import_module(module), name)
+
+
+def classify(user_agent):
+    """Classifies a User-Agent (see ``get_classifier``), at most once per
+    User-Agent.
+    """
+    key = (getattr(settings, 'ADGELETTI_DEVICE_CLASSIFIER', None), user_agent)
+    widths = _classified.get(key, False)
+    if widths is False:
+        widths = get_classifier()(user_agent)
+        _classified.set(key, widths)
+    return widths
+
+
+def get_viewport_widths(request):
+    """Returns the range of viewport widths of the device making the request,
+    as a (min, max) pair, or ``None`` if it can't be estimated.
+    """
+    meta = request.META
+    width = meta.get('HTTP_SEC_CH_VIEWPORT_WIDTH') or meta.get('HTTP_VIEWPORT_WIDTH')
+    if width:
+        try:
+            width = float(width)
+            return width, width
+        except ValueError:
+            pass
+
+    if meta.get('HTTP_SEC_CH_UA_MOBILE') == '?1':
+        return MOBILE_WIDTHS
+
+    user_agent = meta.get('HTTP_USER_AGENT')
+    if user_agent:
+        return classify(user_agent)
+    return None
+
+
+def get_excluded_breakpoints(request):
+    """Returns the set of the names of breakpoints that can't apply to the
+    device making the request (empty if it can't be estimated).
+    """
+    widths = get_viewport_widths(request)
+    if widths is None:
+        return set([])
+
+    excluded = set([])
+    for name, media_query in get_breakpoints():
+        bp_widths = parse_widths(media_query) if media_query else None
+        if bp_widths is None:
+            continue
+        low, high = bp_widths
+        if (low is not None and widths[1] < low) or (high is not None and widths[0] > high):
+            excluded.add(name)
+    return excluded
@@ -0,0 +1,254 @@
+"""Bulk import of ad configuration from manifests.
+
+A manifest lists slots, each with its site (as an ID or a domain), label, ad
+unit, and the sizes allowed for each of its breakpoints. In JSON:
+
+    [
+        {"site": "example.com", "label": "AD-01", "ad_unit": "homepage/top",
+         "positions": {"Mobile": [[320, 50]], "Tablet": [[728, 90], [468, 60]]}}
+    ]
+
+In CSV, with a row per position (or per slot, for slots without positions),
+and sizes separated by spaces:
+
+    site,label,ad_unit,breakpoint,sizes
+    example.com,AD-01,homepage/top,Mobile,320x50
+    example.com,AD-01,homepage/top,Tablet,728x90 468x60
+
+Importing a manifest (see ``import_manifest``) creates and updates the slots,
+positions and sizes it lists, in bulk and in a single transaction, and
+optionally deletes the slots and positions of its sites that it doesn't list.
+"""
+import csv
+import json
+
+from django.contrib.sites.models import Site
+from django.db import transaction
+
+from adgeletti import cache
+from adgeletti.conf import get_breakpoints
+from adgeletti.models import Size, AdSlot, AdPosition, AdPositionLookup
+
+
+class ManifestError(Exception):
+    """Raised for invalid manifests.
+    """
+
+
+def parse_size(value):
+    """Parses a size given as "WIDTHxHEIGHT", or as a [width, height] pair.
+    """
+    try:
+        if isinstance(value, basestring):
+            width, height = value.lower().split('x')
+        else:
+            width, height = value
+        return int(width), int(height)
+    except (TypeError, ValueError):
+        raise ManifestError(u'Invalid size: %r' % (value,))
+
+
+def read_json(f):
+    """Reads the entries of a JSON manifest from a file.
+    """
+    try:
+        data = json.load(f)
+    except ValueError as exc:
+        raise ManifestError(u'Invalid JSON: %s' % exc)
+
+    entries = []
+    for slot in data:
+        try:
+            positions = slot.get('positions', {})
+            entries.append({
+                'site': slot['site'],
+                'label': slot['label'],
+                'ad_unit': slot['ad_unit'],
+                'positions': dict((bp, [parse_size(size) for size in sizes]) for bp, sizes in positions.items()),
+            })
+        except (AttributeError, KeyError, TypeError):
+            raise ManifestError(u'Invalid slot: %r' % (slot,))
+    return entries
+
+
+def read_csv(f):
+    """Reads the entries of a CSV manifest from a file.
+    """
+    entries = {}
+    for row in csv.DictReader(f):
+        try:
+            key = (row['site'], row['label'])
+            entry = entries.setdefault(key, {
+                'site': row['site'],
+                'label': row['label'].decode('utf-8'),
+                'ad_unit': row['ad_unit'].decode('utf-8'),
+                'positions': {},
+            })
+            if row['breakpoint']:
+                entry['positions'][row['breakpoint'].decode('utf-8')] = [parse_size(size) for size in row['sizes'].split()]
+        except (AttributeError, KeyError):
+            raise ManifestError(u'Invalid row: %r' % (row,))
+    return entries.values()
+
+
+def resolve_sites(entries):
+    """Returns a dictionary of the IDs of the sites of the given entries,
+    keyed by the IDs or domains they are given as.
+    """
+    keys = set(entry['site'] for entry in entries)
+    domains = [key for key in keys if isinstance(key, basestring) and not key.isdigit()]
+
+    sites = dict((domain, pk) for pk, domain in Site.objects.filter(domain__in=domains).values_list('pk', 'domain'))
+    ids = [int(key) for key in keys if key not in domains]
+    sites.update((pk, pk) for pk in Site.objects.filter(pk__in=ids).values_list('pk', flat=True))
+    sites.update((str(pk), pk) for pk in ids if pk in sites)
+
+    missing = [key for key in keys if key not in sites]
+    if missing:
+        raise ManifestError(u'Unknown sites: %s' % u', '.join(sorted(map(unicode, missing))))
+    return sites
+
+
+def normalize(entries):
+    """Validates the given entries, returning a dictionary of their ad units
+    and positions, keyed by (site ID, label). Positions are given as
+    dictionaries of sets of sizes, keyed by breakpoint.
+    """
+    sites = resolve_sites(entries)
+    breakpoints = set(name for name, media_query in get_breakpoints())
+    label_length = AdSlot._meta.get_field('label').max_length
+
+    slots = {}
+    for entry in entries:
+        if not entry['label'] or len(entry['label']) > label_length:
+            raise ManifestError(u'Invalid label: %r' % (entry['label'],))
+        unknown = set(entry['positions']) - breakpoints
+        if unknown:
+            raise ManifestError(u'Unknown breakpoints for slot %s: %s' % (entry['label'], u', '.join(sorted(unknown))))
+
+        key = (sites[entry['site']], entry['label'])
+        if key in slots:
+            raise ManifestError(u'Slot %s listed more than once for site %s' % (entry['label'], entry['site']))
+        slots[key] = {
+            'ad_unit': entry['ad_unit'],
+            'positions': dict((bp, set(sizes)) for bp, sizes in entry['positions'].items()),
+        }
+    return slots
+
+
+class Diff(object):
+    """The changes needed to bring the database in line with a manifest. Slots
+    are identified by (site ID, label), positions by (site ID, label,
+    breakpoint), and sizes by (width, height).
+    """
+    def __init__(self):
+        self.sizes_created = []
+        self.slots_created = []
+        self.slots_updated = []
+        self.slots_deleted = []
+        self.positions_created = []
+        self.positions_deleted = []
+        # Lists of (position, size)
+        self.sizes_added = []
+        self.sizes_removed = []
+
+    def __nonzero__(self):
+        return any(self.counts().values())
+
+    def counts(self):
+        """Returns a dictionary of the number of each kind of change.
+        """
+        return dict((name, len(changes)) for name, changes in self.__dict__.items())
+
+
+def import_manifest(entries, prune=False, dry_run=False):
+    """Imports the given manifest entries (see ``read_json`` and
+    ``read_csv``), returning the changes made as a ``Diff``. If ``prune`` is
+    ``True``, slots of the manifest's sites that it doesn't list are deleted,
+    as are positions of its slots that it doesn't list. If ``dry_run`` is
+    ``True``, the changes are only computed.
+    """
+    slots = normalize(entries)
+    site_ids = set(site_id for site_id, label in slots)
+    diff = Diff()
+
+    with transaction.commit_on_success():
+        # Current state
+        sizes = dict(((w, h), pk) for pk, w, h in Size.objects.values_list('pk', 'width', 'height'))
+        current_slots = dict(((site_id, label), (pk, ad_unit)) for pk, site_id, label, ad_unit
+                             in AdSlot.objects.filter(site__in=site_ids).values_list('pk', 'site_id', 'label', 'ad_unit'))
+        slot_keys = dict((pk, key) for key, (pk, ad_unit) in current_slots.items())
+        positions = dict((slot_keys[slot_id] + (bp,), pk) for pk, slot_id, bp
+                         in AdPosition.objects.filter(slot__site__in=site_ids).values_list('pk', 'slot_id', 'breakpoint'))
+        position_keys = dict((pk, key) for key, pk in positions.items())
+        size_keys = dict((pk, key) for key, pk in sizes.items())
+        Through = AdPosition.sizes.through
+        position_sizes = {}
+        for pk, position_id, size_id in Through.objects.filter(adposition__in=position_keys.keys()).values_list('pk', 'adposition_id', 'size_id'):
+            position_sizes.setdefault(position_keys[position_id], {})[size_keys[size_id]] = pk
+
+        # Changes
+        for key, slot in sorted(slots.items()):
+            if key not in current_slots:
+                diff.slots_created.append(key)
+            elif current_slots[key][1] != slot['ad_unit']:
+                diff.slots_updated.append(key)
+            for bp, bp_sizes in sorted(slot['positions'].items()):
+                pos_key = key + (bp,)
+                if pos_key not in positions:
+                    diff.positions_created.append(pos_key)
+                current = position_sizes.get(pos_key, {})
+                diff.sizes_added.extend((pos_key, size) for size in sorted(bp_sizes) if size not in current)
+                diff.sizes_removed.extend((pos_key, size) for size in sorted(current) if size not in bp_sizes)
+        needed = set(size for key, size in diff.sizes_added)
+        diff.sizes_created = sorted(size for size in needed if size not in sizes)
+
+        if prune:
+            diff.slots_deleted = sorted(key for key in current_slots if key not in slots)
+            diff.positions_deleted = sorted(
+                key for key in positions
+                if key[:2] in slots and key[2] not in slots[key[:2]]['positions']
+            )
+
+        if dry_run or not diff:
+            return diff
+
+        # Sizes and slots
+        Size.objects.bulk_create([Size(width=w, height=h) for w, h in diff.sizes_created])
+        sizes = dict(((w, h), pk) for pk, w, h in Size.objects.values_list('pk', 'width', 'height'))
+
+        AdSlot.objects.bulk_create([
+            AdSlot(site_id=site_id, label=label, ad_unit=slots[(site_id, label)]['ad_unit'])
+            for site_id, label in diff.slots_created
+        ])
+        for key in diff.slots_updated:
+            AdSlot.objects.filter(pk=current_slots[key][0]).update(ad_unit=slots[key]['ad_unit'])
+        slot_ids = dict(((site_id, label), pk) for pk, site_id, label
+                        in AdSlot.objects.filter(site__in=site_ids).values_list('pk', 'site_id', 'label'))
+
+        # Positions and their sizes
+        AdPosition.objects.bulk_create([
+            AdPosition(slot_id=slot_ids[key[:2]], breakpoint=key[2]) for key in diff.positions_created
+        ])
+        slot_keys = dict((pk, key) for key, pk in slot_ids.items())
+        positions = dict((slot_keys[slot_id] + (bp,), pk) for pk, slot_id, bp
+                         in AdPosition.objects.filter(slot__site__in=site_ids).values_list('pk', 'slot_id', 'breakpoint'))
+
+        Through.objects.filter(pk__in=[position_sizes[key][size] for key, size in diff.sizes_removed]).delete()
+        Through.objects.bulk_create([
+            Through(adposition_id=positions[key], size_id=sizes[size]) for key, size in diff.sizes_added
+        ])
+
+        # Pruning
+        if diff.positions_deleted:
+            AdPosition.objects.filter(pk__in=[positions[key] for key in diff.positions_deleted]).delete()
+        if diff.slots_deleted:
+            AdSlot.objects.filter(pk__in=[slot_ids[key] for key in diff.slots_deleted]).delete()
+
+        # Bulk changes don't send signals
+        AdPositionLookup.objects.refresh(AdPosition.objects.filter(slot__site__in=site_ids))
+
+    # Only once the changes are committed, so that other processes don't
+    # reload the configuration from the previous one
+    cache.reset()
+    return diff
@@ -0,0 +1,102 @@
+"""A Jinja2 extension providing adgeletti's template tags.
+
+Add ``adgeletti.jinja_ext.AdgelettiExtension`` to an environment's extensions
+to use the tags, with the same semantics and output as the Django ones:
+
+    {% ad "AD-01" Mobile Tablet %}
+    {% ad item.ad_slot Mobile lazy=false %}
+    ...
+    {% adgeletti_go %}
+
+The slot is an expression (usually a string), and breakpoints are names or
+strings. The divs of tags whose slot is a string are built when the template
+is compiled, and stored in its code (so that templates loaded from a bytecode
+cache have them too), so that rendering them only records their positions.
+
+The state shared by the tags of a render is kept in the context, as the
+``_adgeletti`` variable, created by the first tag rendered. Templates whose
+first ad is in an included template should create it beforehand, with
+``{% set _adgeletti = {} %}``.
+"""
+from __future__ import absolute_import
+
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from adgeletti.templatetags.adgeletti_tags import AdNode, AdBlock
+
+
+# Name of the context variable holding the state of a render
+STATE = '_adgeletti'
+
+USAGE = u'usage: {% ad SLOT BREAKPOINT [BREAKPOINT ...] [lazy=false] %}'
+
+
+class RenderContext(object):
+    """Adapts a Jinja2 context to the parts of Django's context used by the
+    tags: ``get``, for variables, and ``render_context``, for the state shared
+    by the tags of a render.
+    """
+    def __init__(self, context):
+        self.context = context
+        state = context.get(STATE)
+        if state is None:
+            state = context.vars[STATE] = {}
+        self.render_context = state
+
+    def get(self, key, default=None):
+        return self.context.get(key, default)
+
+
+class AdgelettiExtension(Extension):
+    """Provides the ``ad`` and ``adgeletti_go`` tags (see ``AdNode`` and
+    ``AdBlock``).
+    """
+    tags = set(['ad', 'adgeletti_go'])
+
+    def parse(self, parser):
+        token = next(parser.stream)
+        if token.value == 'ad':
+            call = self.parse_ad(parser, token.lineno)
+        else:
+            call = self.call_method('render_block', [nodes.ContextReference()])
+        return nodes.Output([call]).set_lineno(token.lineno)
+
+    def parse_ad(self, parser, lineno):
+        """Parses an ``ad`` tag, returning a call rendering it.
+        """
+        if parser.stream.current.type == 'block_end':
+            parser.fail(USAGE, lineno)
+        slot = parser.parse_expression()
+
+        breakpoints, lazy = [], True
+        while parser.stream.current.type != 'block_end':
+            if parser.stream.current.test('name:lazy') and parser.stream.look().test('assign'):
+                parser.stream.skip(2)
+                value = parser.parse_expression()
+                if not isinstance(value, nodes.Const) or not isinstance(value.value, bool):
+                    parser.fail(u'invalid {% ad %} option: lazy must be true or false', lineno)
+                lazy = value.value
+            elif parser.stream.current.type in ('name', 'string'):
+                breakpoints.append(next(parser.stream).value)
+            else:
+                parser.fail(USAGE, lineno)
+        if not breakpoints:
+            parser.fail(USAGE, lineno)
+
+        # The tag's static parts are passed as constants, so that rendering it
+        # only depends on the compiled template
+        literal = isinstance(slot, nodes.Const) and isinstance(slot.value, basestring)
+        divs = AdNode(slot.value, breakpoints, lazy).divs if literal else None
+        args = [nodes.ContextReference(), slot, nodes.Const(breakpoints), nodes.Const(lazy), nodes.Const(divs)]
+        return self.call_method('render_ad', args)
+
+    def render_ad(self, context, slot, breakpoints, lazy, divs):
+        node = AdNode(None, breakpoints, lazy)
+        if divs is None:
+            slot, divs = node.resolve_slot(unicode(slot) if slot else u'')
+        return Markup(node.render_ad(RenderContext(context), slot, divs))
+
+    def render_block(self, context):
+        return Markup(AdBlock().render(RenderContext(context)))
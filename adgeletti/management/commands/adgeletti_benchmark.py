@@ -0,0 +1,56 @@
+import json
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from adgeletti import benchmarks
+
+
+def int_list(value):
+    """Parses a comma-separated list of integers.
+    """
+    try:
+        return [int(v) for v in value.split(',')]
+    except ValueError:
+        raise CommandError(u'Expected a comma-separated list of integers: %s' % value)
+
+
+class Command(BaseCommand):
+    help = (u'Benchmarks the rendering of the adgeletti template tags against '
+            u'synthetic configurations in a test database, outputting the '
+            u'results as JSON.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--slots', default='1,10,100,500',
+                    help=u'Comma-separated numbers of slots to benchmark.'),
+        make_option('--breakpoints', default='1,3,10',
+                    help=u'Comma-separated numbers of breakpoints per slot to benchmark.'),
+        make_option('--sizes', default='1,4',
+                    help=u'Comma-separated numbers of sizes per position to benchmark.'),
+        make_option('--iterations', type='int', default=100,
+                    help=u'Number of renders to measure per scenario.'),
+        make_option('--output',
+                    help=u'File to write the results to, rather than standard output.'),
+    )
+
+    def handle(self, *args, **options):
+        slots = int_list(options['slots'])
+        breakpoints = int_list(options['breakpoints'])
+        sizes = int_list(options['sizes'])
+        verbosity = int(options['verbosity'])
+
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=verbosity, autoclobber=True)
+        try:
+            with benchmarks.private_cache():
+                results = benchmarks.run(slots, breakpoints, sizes, options['iterations'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+        data = json.dumps(results, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(data + '\n')
+        else:
+            self.stdout.write(data + '\n')
@@ -0,0 +1,45 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from adgeletti import importer
+
+
+class Command(BaseCommand):
+    args = u'<manifest>'
+    help = (u'Imports AdSlots, AdPositions and Sizes in bulk from a JSON or CSV '
+            u'manifest (see adgeletti.importer), in a single transaction.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=['json', 'csv'],
+                    help=u'Format of the manifest (by default, guessed from its extension).'),
+        make_option('--prune', action='store_true', default=False,
+                    help=u'Delete slots and positions of the manifest\'s sites that it doesn\'t list.'),
+        make_option('--dry-run', action='store_true', default=False,
+                    help=u'Only output the changes that would be made.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError(u'usage: adgeletti_import <manifest>')
+
+        path = args[0]
+        format = options['format'] or ('csv' if path.lower().endswith('.csv') else 'json')
+        read = importer.read_csv if format == 'csv' else importer.read_json
+
+        try:
+            with open(path, 'rb') as f:
+                entries = read(f)
+            diff = importer.import_manifest(entries, prune=options['prune'], dry_run=options['dry_run'])
+        except (IOError, importer.ManifestError) as exc:
+            raise CommandError(unicode(exc))
+
+        verbosity = int(options['verbosity'])
+        for name, count in sorted(diff.counts().items()):
+            self.stdout.write(u'%s: %d\n' % (name.replace('_', ' ').capitalize(), count))
+            if verbosity > 1:
+                for change in getattr(diff, name):
+                    self.stdout.write(u'    %r\n' % (change,))
+
+        if options['dry_run']:
+            self.stdout.write(u'Dry run; no changes were made.\n')
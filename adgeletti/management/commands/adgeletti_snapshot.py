@@ -0,0 +1,43 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from adgeletti import cache
+
+
+class Command(BaseCommand):
+    args = u'<path>'
+    help = (u'Exports the ad configuration of every site to a snapshot file, for processes '
+            u'to load at startup (see settings.ADGELETTI_SNAPSHOT_FILE).')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--check', action='store_true', default=False,
+                    help=u'Check whether an existing snapshot file matches the database, instead.'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError(u'usage: adgeletti_snapshot <path>')
+        path = args[0]
+
+        if options['check']:
+            try:
+                with open(path, 'rb') as f:
+                    snapshot = cache.read_snapshot(f)
+            except (IOError, cache.SnapshotError) as exc:
+                raise CommandError(unicode(exc))
+            if snapshot['checksum'] != cache.checksum(cache.build_configs()):
+                raise CommandError(u'Snapshot %s differs from the database.' % path)
+            self.stdout.write(u'Snapshot %s matches the database.\n' % path)
+            if snapshot['generation'] != cache.get_generation():
+                self.stdout.write(u'Its generation is stale, so it will be ignored until it is exported again.\n')
+            return
+
+        snapshot = cache.export_snapshot()
+        try:
+            with open(path, 'wb') as f:
+                cache.write_snapshot(f, snapshot)
+        except IOError as exc:
+            raise CommandError(unicode(exc))
+        self.stdout.write(u'Exported the configuration of %d sites to %s (checksum %s).\n'
+                          % (len(snapshot['configs']), path, snapshot['checksum']))
@@ -0,0 +1,45 @@
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+
+from adgeletti.templatetags.adgeletti_tags import AdBlock, get_request_site
+
+
+class ClientHintsMiddleware(object):
+    """Asks browsers for the client hints used to prune the breakpoints of
+    ads (see ``adgeletti.devices``), and marks responses as varying with them,
+    and with the User-Agent header, so that caches keep a copy for each.
+    """
+    HINTS = ('Sec-CH-Viewport-Width', 'Viewport-Width', 'Sec-CH-UA-Mobile')
+
+    def process_response(self, request, response):
+        hints = [hint.strip() for hint in response.get('Accept-CH', '').split(',') if hint.strip()]
+        hints.extend(hint for hint in self.HINTS if hint not in hints)
+        response['Accept-CH'] = ', '.join(hints)
+        patch_vary_headers(response, self.HINTS + ('User-Agent',))
+        return response
+
+
+class PlaceholderMiddleware(object):
+    """Replaces the placeholders emitted by ``{% adgeletti_go %}`` when
+    ``settings.ADGELETTI_DEFERRED`` is ``True`` with the scripts defining the
+    positions of their ads, from the current ad configuration. To fill in
+    pages served from a full-page cache, it must come before the cache's
+    middleware (and after any middleware compressing responses) in
+    ``MIDDLEWARE_CLASSES``, so that it processes responses after them.
+
+    Only HTML responses are processed, and not those whose content is an
+    iterator (e.g., streamed ones), as reading it would consume it.
+    """
+    def process_response(self, request, response):
+        if (getattr(response, 'streaming', False) or getattr(response, '_base_content_is_iter', False)
+                or not response.get('Content-Type', '').startswith('text/html')
+                or response.has_header('Content-Encoding')
+                or '<!--adgeletti:' not in response.content):
+            return response
+
+        content = response.content.decode(settings.DEFAULT_CHARSET)
+        content = AdBlock.fill_placeholders(content, get_request_site(request))
+        response.content = content.encode(settings.DEFAULT_CHARSET)
+        if response.has_header('Content-Length'):
+            response['Content-Length'] = str(len(response.content))
+        return response
@@ -1,8 +1,15 @@
+import sys
+
+from django.core.signals import request_finished
+from django.core.validators import MinValueValidator
 from django.db import models
+from django.db.models import signals
 from django.utils.text import ugettext_lazy as _
 from django.contrib.sites.models import Site
 from django.conf import settings
 
+from adgeletti.conf import get_breakpoints
+
 
 class Size(models.Model):
     """The size of an ad.
@@ -39,8 +46,199 @@ class AdPosition(models.Model):
     """Configures how a slot is to be displayed for a given breakpoint.
     """
     slot = models.ForeignKey('adgeletti.AdSlot', verbose_name=_(u'slot'))
-    breakpoint = models.CharField(_(u'breakpoint'), max_length=25, choices=[(bp, bp) for bp in settings.ADGELETTI_BREAKPOINTS])
+    breakpoint = models.CharField(_(u'breakpoint'), max_length=25, choices=[(bp, bp) for bp, media_query in get_breakpoints()])
     sizes = models.ManyToManyField(Size, verbose_name=_(u'allowed sizes'))
 
     class Meta:
         unique_together = ('slot', 'breakpoint')
+
+
+# The minimum number of seconds between refreshes of an ad, as ad servers
+# (e.g., DFP) expect
+MIN_REFRESH_INTERVAL = 30
+
+
+class AdRefresh(models.Model):
+    """Configures the periodic refresh of an ``AdPosition``'s ad, while it is
+    showing and on screen.
+    """
+    position = models.OneToOneField(AdPosition, verbose_name=_(u'position'), related_name='refresh')
+    interval = models.PositiveIntegerField(_(u'interval'), validators=[MinValueValidator(MIN_REFRESH_INTERVAL)],
+                                           help_text=_(u'The number of seconds between refreshes (at least 30).'))
+    max_refreshes = models.PositiveIntegerField(_(u'maximum refreshes'), default=0, help_text=_(u'The number of times to refresh the ad, or 0 for no limit.'))
+
+    class Meta:
+        verbose_name = _(u'ad refresh')
+
+    def __unicode__(self):
+        return _(u'Every %ds') % self.interval
+
+
+def pack_sizes(sizes):
+    """Packs a list of sizes into a string, such as "300x250,728x90".
+    """
+    return u','.join(u'%dx%d' % (size.width, size.height) for size in sizes)
+
+
+def unpack_sizes(packed):
+    """Unpacks a string of sizes packed by ``pack_sizes`` into a list of
+    [width, height] pairs.
+    """
+    return [map(int, size.split(u'x')) for size in packed.split(u',') if size]
+
+
+class AdPositionLookupManager(models.Manager):
+    """Manager for ``AdPositionLookup``, providing the page-level lookup and
+    the means of keeping the table in sync with the positions.
+    """
+    def for_site(self, site):
+        """Returns the lookups of the given site's positions.
+        """
+        return self.get_query_set().filter(site=site)
+
+    def for_page(self, site, slots, breakpoints):
+        """Returns the lookups of the given site's positions for the given slot
+        labels and breakpoints, with a single query on the table's index.
+        """
+        return self.for_site(site).filter(label__in=slots, breakpoint__in=breakpoints)
+
+    def refresh(self, positions):
+        """Rebuilds the lookups of the given queryset of positions.
+        """
+        positions = list(positions.select_related('slot', 'refresh').prefetch_related('sizes'))
+        self.get_query_set().filter(position__in=[pos.pk for pos in positions]).delete()
+        self.bulk_create([AdPositionLookup.from_position(pos) for pos in positions])
+
+    def rebuild(self):
+        """Rebuilds every lookup, for use after changes that don't send
+        signals, such as bulk inserts and updates.
+        """
+        self.get_query_set().all().delete()
+        self.refresh(AdPosition.objects.all())
+
+
+class AdPositionLookup(models.Model):
+    """A denormalized copy of an ``AdPosition``, with its slot's site, label
+    and ad unit, and its sizes packed into a string (see ``pack_sizes``), so
+    that the positions of a page can be found with a single query, without
+    joins. Kept in sync with the positions, slots and sizes it copies when
+    they're saved or deleted.
+    """
+    position = models.OneToOneField(AdPosition, primary_key=True, related_name='lookup')
+    site = models.ForeignKey(Site)
+    label = models.CharField(max_length=25)
+    breakpoint = models.CharField(max_length=25)
+    ad_unit = models.CharField(max_length=255)
+    sizes = models.TextField(blank=True)
+    refresh_interval = models.PositiveIntegerField(null=True)
+    max_refreshes = models.PositiveIntegerField(null=True)
+
+    objects = AdPositionLookupManager()
+
+    class Meta:
+        unique_together = ('site', 'label', 'breakpoint')
+
+    @classmethod
+    def from_position(cls, pos):
+        """Returns an (unsaved) lookup for the given position.
+        """
+        try:
+            refresh = pos.refresh
+        except AdRefresh.DoesNotExist:
+            refresh = None
+        return cls(
+            position=pos,
+            site_id=pos.slot.site_id,
+            label=pos.slot.label,
+            breakpoint=pos.breakpoint,
+            ad_unit=pos.slot.ad_unit,
+            sizes=pack_sizes(pos.sizes.all()),
+            refresh_interval=refresh and refresh.interval,
+            max_refreshes=refresh and refresh.max_refreshes,
+        )
+
+    def ad_unit_id(self):
+        return u'%s/%s' % (settings.ADGELETTI_DFP_NETWORK_ID, self.ad_unit)
+
+    def size_list(self):
+        return unpack_sizes(self.sizes)
+
+    def refresh_config(self):
+        """Returns the position's refresh configuration, as an [interval,
+        max_refreshes] pair, or ``None`` if it isn't refreshed.
+        """
+        if self.refresh_interval is None:
+            return None
+        return [self.refresh_interval, self.max_refreshes]
+
+
+# Keep the lookup table in sync with the positions, slots and sizes it copies.
+# Deleting a position (or its slot) deletes its lookup along with it.
+def sync_position(sender, instance, raw=False, **kwargs):
+    if not raw:
+        AdPositionLookup.objects.refresh(AdPosition.objects.filter(pk=instance.pk))
+
+
+def sync_refresh(sender, instance, raw=False, **kwargs):
+    if not raw:
+        AdPositionLookup.objects.refresh(AdPosition.objects.filter(pk=instance.position_id))
+
+
+def sync_slot(sender, instance, created=False, raw=False, **kwargs):
+    if not (created or raw):
+        AdPositionLookup.objects.refresh(AdPosition.objects.filter(slot=instance))
+
+
+def sync_size(sender, instance, created=False, raw=False, **kwargs):
+    if not (created or raw):
+        AdPositionLookup.objects.refresh(AdPosition.objects.filter(sizes=instance))
+
+
+def remember_size_positions(sender, instance, **kwargs):
+    # The size's positions are only known until it's deleted
+    instance._adgeletti_positions = list(instance.adposition_set.values_list('pk', flat=True))
+
+
+def sync_deleted_size(sender, instance, **kwargs):
+    AdPositionLookup.objects.refresh(AdPosition.objects.filter(pk__in=instance._adgeletti_positions))
+
+
+def sync_sizes(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            AdPositionLookup.objects.refresh(AdPosition.objects.filter(pk=instance.pk))
+    elif action == 'pre_clear':
+        remember_size_positions(sender, instance)
+    elif action == 'post_clear':
+        sync_deleted_size(sender, instance)
+    elif action.startswith('post_'):
+        AdPositionLookup.objects.refresh(AdPosition.objects.filter(pk__in=pk_set))
+
+
+def rebuild_lookups(sender, **kwargs):
+    AdPositionLookup.objects.rebuild()
+
+
+signals.post_save.connect(sync_position, sender=AdPosition)
+signals.post_save.connect(sync_refresh, sender=AdRefresh)
+signals.post_delete.connect(sync_refresh, sender=AdRefresh)
+signals.post_save.connect(sync_slot, sender=AdSlot)
+signals.post_save.connect(sync_size, sender=Size)
+signals.pre_delete.connect(remember_size_positions, sender=Size)
+signals.post_delete.connect(sync_deleted_size, sender=Size)
+signals.m2m_changed.connect(sync_sizes, sender=AdPosition.sizes.through)
+# Populate the table for positions created before it was
+signals.post_syncdb.connect(rebuild_lookups, sender=sys.modules[__name__])
+
+
+# Discard cached ad configuration whenever it changes
+from adgeletti import cache
+
+for model in (Size, AdSlot, AdPosition, AdRefresh):
+    signals.post_save.connect(cache.invalidate, sender=model)
+    signals.post_delete.connect(cache.invalidate, sender=model)
+signals.m2m_changed.connect(cache.invalidate, sender=AdPosition.sizes.through)
+request_finished.connect(cache.flush_invalidation)
+
+# Load the snapshot file, if any, as the process starts
+cache.load_snapshot_file()
@@ -0,0 +1,61 @@
+"""Loading of the positions of a page's ads ahead of rendering.
+
+Views that know which ads their page displays can load their positions before
+rendering the page (see ``preload``), passing them to the template as its
+``adgeletti_preloaded`` variable:
+
+    preloaded = preload(request, ['AD-01', 'AD-02'], ['Mobile', 'Tablet'])
+    return render(request, 'page.html', {'adgeletti_preloaded': preloaded})
+
+The template's tags then define the positions from them, without querying the
+database (other than for ads that weren't preloaded).
+"""
+from adgeletti.conf import get_breakpoints
+from adgeletti.templatetags.adgeletti_tags import AdNode, get_positions, get_request_site
+
+
+class Preloaded(object):
+    """The positions of a site's ads for a set of slots and breakpoints.
+    """
+    def __init__(self, site, positions):
+        self.site = site
+        # Data of each position (see ``get_positions``), or ``None`` for slots
+        # and breakpoints without one, keyed by (slot, breakpoint)
+        self.positions = positions
+
+    def get_positions(self, ads):
+        """Returns the data of the positions of the page's ads, as
+        ``get_positions`` would. Those of ads that weren't preloaded are
+        loaded as usual.
+        """
+        positions, missing = [], {}
+        for slot, divs in ads.items():
+            for breakpoint, div_id in divs.items():
+                if (slot, breakpoint) not in self.positions:
+                    missing.setdefault(slot, {})[breakpoint] = div_id
+                    continue
+                pos = self.positions[(slot, breakpoint)]
+                if pos is not None:
+                    positions.append(pos if pos['div_id'] == div_id else dict(pos, div_id=div_id))
+        if missing:
+            positions.extend(get_positions(self.site, missing))
+        return positions
+
+
+def preload(request, slots, breakpoints=None):
+    """Loads the positions of the request's site for the given slots and
+    breakpoints (by default, all of them), returning them as a ``Preloaded``.
+    """
+    site = get_request_site(request)
+    if breakpoints is None:
+        breakpoints = [name for name, media_query in get_breakpoints()]
+
+    keys = dict((AdNode.div_id(slot, bp), (slot, bp)) for slot in slots for bp in breakpoints)
+    ads = {}
+    for div_id, (slot, bp) in keys.items():
+        ads.setdefault(slot, {})[bp] = div_id
+
+    positions = dict((key, None) for key in keys.values())
+    for pos in get_positions(site, ads):
+        positions[keys[pos['div_id']]] = pos
+    return Preloaded(site, positions)
@@ -0,0 +1,32 @@
+"""Signals sent after rendering adgeletti's template tags, for instrumentation.
+
+They are only sent, and the renders only measured, when they have receivers.
+Receivers may be connected as with any signal, or be given as the dotted paths
+of functions in ``settings.ADGELETTI_INSTRUMENTATION``, e.g.:
+
+    ADGELETTI_INSTRUMENTATION = ('myproject.metrics.record_ad_render',)
+
+Both signals provide the number of seconds the render took ("duration"), the
+number of queries it ran ("queries") and the number of bytes it output
+("bytes").
+"""
+from django.conf import settings
+from django.dispatch import Signal
+from django.utils.importlib import import_module
+
+
+# Sent by ``AdNode`` after rendering ``{% ad ... %}``, also providing the tag's
+# slot ("slot")
+ad_rendered = Signal(providing_args=['slot', 'duration', 'queries', 'bytes'])
+
+# Sent by ``AdBlock`` after rendering ``{% adgeletti_go %}``, also providing
+# the number of positions defined ("positions"), and whether the output was
+# memoized ("cache_hit"; ``None`` if it can't be)
+block_rendered = Signal(providing_args=['positions', 'cache_hit', 'duration', 'queries', 'bytes'])
+
+
+for path in getattr(settings, 'ADGELETTI_INSTRUMENTATION', ()):
+    module, name = path.rsplit('.', 1)
+    receiver = getattr(import_module(module), name)
+    ad_rendered.connect(receiver, weak=False, dispatch_uid=path)
+    block_rendered.connect(receiver, weak=False, dispatch_uid=path)
@@ -1,8 +1,14 @@
-// @requires GPT library (e.g., //www.googletagservices.com/tag/js/gpt.js)
+// @requires GPT library (e.g., //securepubads.g.doubleclick.net/tag/js/gpt.js),
+// which may be loaded asynchronously, before or after this script
 
 // Set up a simple console noop for clients without a console
 window.console = window.console || {log: function(m){}};
 
+// Set up GPT's command queue, so that calls to GPT can be queued until it has
+// loaded (GPT then runs them, and those queued later, immediately)
+window.googletag = window.googletag || {};
+googletag.cmd = googletag.cmd || [];
+
 
 // Set up the `Adgeletti` object and its methods
 window.Adgeletti = {
@@ -10,24 +16,190 @@ window.Adgeletti = {
     data: {
         // A dictionary of ad positions, keyed by their respective breakpoints
         positions: {},
-        // A dictionary of ad positions that are showing, keyed by their
-        // respective breakpoints
+        // A dictionary of dictionaries of ad positions that are showing,
+        // keyed by their respective breakpoints, then by their div ids
         showing: {},
         // A dictionary of ad positions that have been displayed, keyed by
-        // their respective breakpoints
-        displayed: {}
+        // their div ids
+        displayed: {},
+        // Whether GPT's single request architecture has been enabled (see
+        // `defineSlot`)
+        single_request_enabled: false,
+        // A dictionary of ad positions waiting to be loaded lazily, keyed by
+        // their div ids (see `observe`)
+        lazy: {},
+        // A dictionary of `MediaQueryList`s, and one of whether they match,
+        // keyed by their respective breakpoints (see `watch`)
+        media: {},
+        matching: {},
+        // Whether a switch of breakpoints is scheduled (see `scheduleSwitch`)
+        switch_scheduled: false,
+        // A dictionary of ad positions to be refreshed periodically, keyed by
+        // their div ids, and the timeout for the next refresh of any of them
+        // (see `scheduleRefresh`)
+        refreshing: {},
+        refresh_timeout: null
+    },
+
+    // Options, as set via `configure`
+    options: {
+        // Whether to fetch all of a breakpoint's ads with a single request,
+        // using GPT's single request architecture
+        single_request: false,
+        // Whether to wait for the divs of ads to approach the viewport before
+        // fetching them, and how closely (as a CSS margin around it)
+        lazy_load: false,
+        lazy_root_margin: '200px',
+        // The minimum number of seconds between refreshes of an ad, to which
+        // shorter intervals are raised, so as not to flood the ad server
+        min_refresh_interval: 30,
+        // A dictionary of media queries, keyed by their respective
+        // breakpoints, for which ads are displayed and hidden automatically
+        // (see `watch`)
+        breakpoints: {}
+    },
+
+    // Sets the given options (see `options`)
+    configure: function(options){
+        for(var key in options){
+            if(options.hasOwnProperty(key)){
+                this.options[key] = options[key];
+            }
+        }
+
+        if(options.breakpoints){
+            this.watch();
+        }
+    },
+
+    // Listens for changes to whether the media queries in
+    // `options.breakpoints` match, displaying the ads of breakpoints that
+    // start matching and hiding those of ones that stop (see
+    // `switchBreakpoints`)
+    watch: function(){
+        var self = this;
+        var queries = this.options.breakpoints;
+        var listener = function(){
+            self.scheduleSwitch();
+        };
+
+        if(!window.matchMedia){
+            console.log('Media queries are not supported; breakpoints must be displayed manually');
+            return;
+        }
+
+        for(var breakpoint in queries){
+            if(!queries.hasOwnProperty(breakpoint) || this.data.media[breakpoint]){
+                continue;
+            }
+            var media = this.data.media[breakpoint] = window.matchMedia(queries[breakpoint]);
+            if(media.addEventListener){
+                media.addEventListener('change', listener);
+            }else{
+                media.addListener(listener);
+            }
+        }
+
+        this.scheduleSwitch();
+    },
+
+    // Schedules a switch of breakpoints (see `switchBreakpoints`) for the
+    // next animation frame, unless one already is, so that the resulting
+    // changes to the page are made together
+    scheduleSwitch: function(){
+        var self = this;
+        var request = window.requestAnimationFrame || function(callback){
+            return setTimeout(callback, 16);
+        };
+
+        if(this.data.switch_scheduled){
+            return;
+        }
+        this.data.switch_scheduled = true;
+
+        request(function(){
+            self.data.switch_scheduled = false;
+            self.switchBreakpoints();
+        });
+    },
+
+    // Hides the ads of breakpoints whose media queries stopped matching, then
+    // displays those of breakpoints whose media queries started matching
+    switchBreakpoints: function(){
+        var media = this.data.media;
+        var matching = this.data.matching;
+        var breakpoint;
+
+        for(breakpoint in media){
+            if(media.hasOwnProperty(breakpoint) && matching[breakpoint] && !media[breakpoint].matches){
+                matching[breakpoint] = false;
+                this.hide(breakpoint);
+            }
+        }
+
+        for(breakpoint in media){
+            if(media.hasOwnProperty(breakpoint) && !matching[breakpoint] && media[breakpoint].matches){
+                matching[breakpoint] = true;
+                this.display(breakpoint);
+            }
+        }
     },
 
     // Sets up an ad position by adding it to `data.positions`
     position: function(json_str){
         // Required in the provided JSON are the following keys: "breakpoint",
         // "ad_unit_id", "sizes", and "div_id"
+        // (and "refresh", for positions that are refreshed periodically)
         var options = JSON.parse(json_str);
-        var positions = this.data.positions[options.breakpoint] = this.data.positions[options.breakpoint] || [];
+        this.addPosition(options.breakpoint, options.ad_unit_id, options.sizes, options.div_id, options.refresh);
+    },
+
+    // Sets up the ad positions in a compact payload (as output by
+    // `{% adgeletti_go %}` when `ADGELETTI_COMPACT_PAYLOAD` is set), which
+    // is an array of: the payload format's version, the DFP network ID, an
+    // array of breakpoints, an array of sizes, and an array of positions, as
+    // arrays of the index of their breakpoint, their ad unit ID (without the
+    // network ID), their div's id (without its "adgeletti-ad-div-" prefix),
+    // an array of the indexes of their sizes, and (for positions that are
+    // refreshed periodically) their refresh configuration
+    load: function(payload){
+        if(payload[0] !== 1){
+            console.log('Unsupported payload version ' + payload[0]);
+            return;
+        }
+
+        var network = payload[1];
+        var breakpoints = payload[2];
+        var sizes = payload[3];
+        var positions = payload[4];
+
+        for(var i = 0; i < positions.length; ++i){
+            var pos = positions[i];
+            var pos_sizes = [];
+            for(var j = 0; j < pos[3].length; ++j){
+                pos_sizes.push(sizes[pos[3][j]]);
+            }
+            this.addPosition(
+                breakpoints[pos[0]],
+                network ? network + '/' + pos[1] : pos[1],
+                pos_sizes,
+                'adgeletti-ad-div-' + pos[2],
+                pos[4]
+            );
+        }
+    },
+
+    // Adds an ad position to `data.positions`. Positions that are refreshed
+    // periodically are given their refresh configuration, as an array of the
+    // number of seconds between refreshes and the maximum number of
+    // refreshes (0 for no limit).
+    addPosition: function(breakpoint, ad_unit_id, sizes, div_id, refresh){
+        var positions = this.data.positions[breakpoint] = this.data.positions[breakpoint] || [];
         positions.push({
-            ad_unit_id: options.ad_unit_id,
-            sizes: options.sizes,
-            div_id: options.div_id
+            ad_unit_id: ad_unit_id,
+            sizes: sizes,
+            div_id: div_id,
+            refresh: refresh || null
         });
     },
 
@@ -35,59 +207,328 @@ window.Adgeletti = {
     display: function(breakpoint){
         console.log('Displaying ads for breakpoint "' + breakpoint + '"');
 
-        // Ensure a list for the breakpoint in `data.displayed`
-        var displayed = this.data.displayed[breakpoint] = this.data.displayed[breakpoint] || [];
-        // Ensure a list for the breakpoint in `data.showing`
-        var showing = this.data.showing[breakpoint] = this.data.showing[breakpoint] || [];
+        var displayed = this.data.displayed;
+        // Ensure a dictionary for the breakpoint in `data.showing`
+        var showing = this.data.showing[breakpoint] = this.data.showing[breakpoint] || {};
         // Get a list of positions for the breakpoint, or an empty list
         var positions = this.data.positions[breakpoint] || [];
+        // Lists of positions to be fetched now, and once their divs approach
+        // the viewport
+        var eager = [];
+        var lazy = [];
 
         // Loop through the breakpoint's positions, showing each's div, and
-        // using `googletag.pubads().display(...)` to display ones that haven't
-        // already been displayed
+        // fetching the ads of ones that haven't already been displayed
         for(var i = 0; i < positions.length; ++i){
             var pos = positions[i];
+            var div = document.getElementById(pos.div_id);
 
-            // Add the position to the list of showing positions, so that its
-            // div can be hidden via `this.hide(...)`
-            showing.push(pos);
-
-            // Show the div and add it to `data.showing`
-            console.log('Showing ad div #' + pos.div_id);
-            document.getElementById(pos.div_id).style.display = 'block';
+            // Show the div and add the position to `data.showing`, so that
+            // its div can be hidden via `this.hide(...)`
+            if(!showing.hasOwnProperty(pos.div_id)){
+                console.log('Showing ad div #' + pos.div_id);
+                div.style.display = 'block';
+                showing[pos.div_id] = pos;
+            }
 
             // Check whether the ad has already been displayed
-            for(var j = 0; j < displayed.length; j ++){
-                if(displayed[j].div_id == pos.div_id){
-                    console.log('Ad ' + pos.ad_unit_id + ' already displayed for breakpoint "' + breakpoint + '"');
-                    return;
+            if(displayed.hasOwnProperty(pos.div_id)){
+                console.log('Ad ' + pos.ad_unit_id + ' already displayed for breakpoint "' + breakpoint + '"');
+                continue;
+            }
+
+            // Add the position to the displayed positions
+            displayed[pos.div_id] = pos;
+
+            // Ads are loaded lazily unless their div opts out of it (see
+            // `{% ad ... lazy=false %}`)
+            if(this.options.lazy_load && div.getAttribute('data-adgeletti-lazy') != 'false'){
+                lazy.push(pos);
+            }else{
+                eager.push(pos);
+            }
+        }
+
+        this.fetch(eager);
+        this.observe(lazy);
+    },
+
+    // Fetches the ads of the given positions, using
+    // `googletag.pubads().display(...)` for each (or defining their slots
+    // and fetching them together, when using a single request), once GPT
+    // has loaded
+    fetch: function(positions){
+        var self = this;
+
+        if(!positions.length){
+            return;
+        }
+
+        googletag.cmd.push(function(){
+            var slots = [];
+
+            for(var i = 0; i < positions.length; ++i){
+                var pos = positions[i];
+
+                if(self.options.single_request){
+                    slots.push(self.defineSlot(pos));
+                    continue;
+                }
+
+                // Tell Google to display the ad
+                console.log('Displaying ad ' + pos.ad_unit_id + ' in div #' + pos.div_id);
+                googletag.pubads().display(pos.ad_unit_id, pos.sizes, pos.div_id);
+            }
+
+            // Fetch the defined slots, with a single request
+            if(slots.length){
+                console.log('Fetching ' + slots.length + ' ads');
+                googletag.pubads().refresh(slots);
+            }
+
+            for(var i = 0; i < positions.length; ++i){
+                if(positions[i].refresh){
+                    self.scheduleRefresh(positions[i]);
                 }
             }
+        });
+    },
+
+    // Schedules the periodic refresh of a position whose ad has been
+    // fetched. A single timeout is kept for all positions, and positions due
+    // for a refresh at the same time are refreshed together (see
+    // `refreshDue`).
+    scheduleRefresh: function(pos){
+        var self = this;
+
+        pos.refresh_interval = Math.max(pos.refresh[0], this.options.min_refresh_interval);
+        console.log('Refreshing ad div #' + pos.div_id + ' every ' + pos.refresh_interval + 's');
+        pos.refreshes = 0;
+        pos.refresh_due = new Date().getTime() + pos.refresh_interval * 1000;
+        this.data.refreshing[pos.div_id] = pos;
+
+        // Refreshes are paused while the page is hidden, and resumed once it
+        // is visible again
+        if(!this.data.visibility_listening && document.addEventListener){
+            document.addEventListener('visibilitychange', function(){
+                if(!document.hidden){
+                    self.refreshDue();
+                }
+            }, false);
+            this.data.visibility_listening = true;
+        }
+
+        this.startRefreshTimeout();
+    },
+
+    // Sets the timeout for the next refresh of any position in
+    // `data.refreshing`, unless one is already set. Positions due for a
+    // refresh but off screen are checked again every second.
+    startRefreshTimeout: function(){
+        var self = this;
+        var next = null;
+
+        if(this.data.refresh_timeout !== null){
+            return;
+        }
+
+        for(var div_id in this.data.refreshing){
+            if(this.data.refreshing.hasOwnProperty(div_id)){
+                var due = this.data.refreshing[div_id].refresh_due;
+                next = next === null ? due : Math.min(next, due);
+            }
+        }
+        if(next === null){
+            return;
+        }
+
+        this.data.refresh_timeout = setTimeout(function(){
+            self.data.refresh_timeout = null;
+            self.refreshDue();
+        }, Math.max(next - new Date().getTime(), 1000));
+    },
+
+    // Refreshes the ads of the positions in `data.refreshing` that are due
+    // for it, and whose divs are showing and on screen, with a single call,
+    // unless the page is hidden
+    refreshDue: function(){
+        var self = this;
+        var now = new Date().getTime();
+        var due = [];
+
+        clearTimeout(this.data.refresh_timeout);
+        this.data.refresh_timeout = null;
+        if(document.hidden){
+            return;
+        }
+
+        for(var div_id in this.data.refreshing){
+            if(!this.data.refreshing.hasOwnProperty(div_id)){
+                continue;
+            }
+            var pos = this.data.refreshing[div_id];
+            if(pos.refresh_due > now || !this.isNear(document.getElementById(div_id), 0)){
+                continue;
+            }
+
+            due.push(pos);
+            pos.refresh_due = now + pos.refresh_interval * 1000;
+            if(++pos.refreshes === pos.refresh[1]){
+                delete this.data.refreshing[div_id];
+            }
+        }
+
+        if(due.length){
+            googletag.cmd.push(function(){
+                var slots = [];
+                for(var i = 0; i < due.length; ++i){
+                    var slot = self.getSlot(due[i]);
+                    if(slot){
+                        slots.push(slot);
+                    }
+                }
+                if(slots.length){
+                    console.log('Refreshing ' + slots.length + ' ads');
+                    googletag.pubads().refresh(slots);
+                }
+            });
+        }
+
+        this.startRefreshTimeout();
+    },
+
+    // Returns the GPT slot of a position whose ad has been fetched
+    getSlot: function(pos){
+        if(!pos.slot){
+            var slots = googletag.pubads().getSlots();
+            for(var i = 0; i < slots.length; ++i){
+                if(slots[i].getSlotElementId() == pos.div_id){
+                    pos.slot = slots[i];
+                }
+            }
+        }
+        return pos.slot || null;
+    },
+
+    // Waits for the divs of the given positions to approach the viewport
+    // (within `options.lazy_root_margin`) before fetching their ads, using
+    // an `IntersectionObserver`, or scroll and resize listeners in browsers
+    // without one
+    observe: function(positions){
+        var self = this;
+        var lazy = this.data.lazy;
+
+        if(!positions.length){
+            return;
+        }
+
+        for(var i = 0; i < positions.length; ++i){
+            console.log('Waiting for ad div #' + positions[i].div_id + ' to approach the viewport');
+            lazy[positions[i].div_id] = positions[i];
+        }
+
+        if(window.IntersectionObserver){
+            if(!this.data.observer){
+                this.data.observer = new IntersectionObserver(function(entries){
+                    var due = [];
+                    for(var i = 0; i < entries.length; ++i){
+                        var div = entries[i].target;
+                        if(entries[i].isIntersecting && lazy[div.id]){
+                            due.push(lazy[div.id]);
+                            delete lazy[div.id];
+                            self.data.observer.unobserve(div);
+                        }
+                    }
+                    self.fetch(due);
+                }, {rootMargin: this.options.lazy_root_margin});
+            }
+
+            for(var i = 0; i < positions.length; ++i){
+                this.data.observer.observe(document.getElementById(positions[i].div_id));
+            }
+            return;
+        }
+
+        if(!this.data.lazy_listening && window.addEventListener){
+            // Check at most once every 100ms while scrolling or resizing
+            var timeout = null;
+            var listener = function(){
+                if(timeout === null){
+                    timeout = setTimeout(function(){
+                        timeout = null;
+                        self.fetchVisible();
+                    }, 100);
+                }
+            };
+            window.addEventListener('scroll', listener, false);
+            window.addEventListener('resize', listener, false);
+            this.data.lazy_listening = true;
+        }
+        this.fetchVisible();
+    },
+
+    // Fetches the ads of the positions waiting in `data.lazy` whose divs are
+    // showing and within `options.lazy_root_margin` of the viewport
+    fetchVisible: function(){
+        var margin = parseInt(this.options.lazy_root_margin, 10) || 0;
+        var due = [];
+
+        for(var div_id in this.data.lazy){
+            if(this.data.lazy.hasOwnProperty(div_id) && this.isNear(document.getElementById(div_id), margin)){
+                due.push(this.data.lazy[div_id]);
+                delete this.data.lazy[div_id];
+            }
+        }
+
+        this.fetch(due);
+    },
 
-            // Add the position to the list of displayed positions
-            displayed.push(pos);
+    // Returns whether the given div is showing and within the given number
+    // of pixels of the viewport
+    isNear: function(div, margin){
+        if(div.style.display == 'none'){
+            return false;
+        }
+        var height = window.innerHeight || document.documentElement.clientHeight;
+        var rect = div.getBoundingClientRect();
+        return rect.top < height + margin && rect.bottom > -margin;
+    },
 
-            // Tell Google to display the ad
-            console.log('Displaying ad ' + pos.ad_unit_id + ' for breakpoint "' + breakpoint + '"');
-            googletag.pubads().display(pos.ad_unit_id, pos.sizes, pos.div_id);
+    // Defines the GPT slot of an ad position, without fetching its ad (see
+    // `fetch`), and returns it. GPT must have loaded. GPT's single request
+    // architecture is enabled first, if it hasn't been yet.
+    defineSlot: function(pos){
+        if(!this.data.single_request_enabled){
+            // Initial loading is disabled, so that ads are only fetched when
+            // their slots are refreshed, allowing those of a breakpoint to
+            // be fetched together
+            googletag.pubads().enableSingleRequest();
+            googletag.pubads().disableInitialLoad();
+            googletag.enableServices();
+            this.data.single_request_enabled = true;
         }
+
+        console.log('Defining slot for ad ' + pos.ad_unit_id + ' in div #' + pos.div_id);
+        pos.slot = googletag.defineSlot(pos.ad_unit_id, pos.sizes, pos.div_id).addService(googletag.pubads());
+        googletag.display(pos.div_id);
+        return pos.slot;
     },
 
     // Hides all the ads in the page for the given breakpoint
     hide: function(breakpoint){
         console.log('Hiding ads for breakpoint "' + breakpoint + '"');
 
-        // Get a list of showing positions for the breakpoint, or an empty list
-        var showing = this.data.showing[breakpoint] || [];
-        for(var i = 0; i < showing.length; ++i){
-            var pos = showing[i];
-
-            // Hide the ad div
-            console.log('Hiding ad div #' + pos.div_id);
-            document.getElementById(pos.div_id).style.display = 'none';
+        // Get the showing positions for the breakpoint, if any
+        var showing = this.data.showing[breakpoint] || {};
+        for(var div_id in showing){
+            if(showing.hasOwnProperty(div_id)){
+                // Hide the ad div
+                console.log('Hiding ad div #' + div_id);
+                document.getElementById(div_id).style.display = 'none';
+            }
         }
 
-        // Reset the list of showing positions
-        this.data.showing[breakpoint] = [];
+        // Reset the showing positions
+        this.data.showing[breakpoint] = {};
     }
 }
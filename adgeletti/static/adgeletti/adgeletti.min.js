@@ -1 +1 @@
-window.console=window.console||{log:function(a){}};window.Adgeletti={data:{positions:{},showing:{},displayed:{}},position:function(a){var c=JSON.parse(a);var b=this.data.positions[c.breakpoint]=this.data.positions[c.breakpoint]||[];b.push({ad_unit_id:c.ad_unit_id,sizes:c.sizes,div_id:c.div_id})},display:function(b){console.log('Displaying ads for breakpoint "'+b+'"');var e=this.data.displayed[b]=this.data.displayed[b]||[];var f=this.data.showing[b]=this.data.showing[b]||[];var a=this.data.positions[b]||[];for(var d=0;d<a.length;++d){var g=a[d];f.push(g);console.log("Showing ad div #"+g.div_id);document.getElementById(g.div_id).style.display="block";for(var c=0;c<e.length;c++){if(e[c].div_id==g.div_id){console.log("Ad "+g.ad_unit_id+' already displayed for breakpoint "'+b+'"');return}}e.push(g);console.log("Displaying ad "+g.ad_unit_id+' for breakpoint "'+b+'"');googletag.pubads().display(g.ad_unit_id,g.sizes,g.div_id)}},hide:function(a){console.log('Hiding ads for breakpoint "'+a+'"');var c=this.data.showing[a]||[];for(var b=0;b<c.length;++b){var d=c[b];console.log("Hiding ad div #"+d.div_id);document.getElementById(d.div_id).style.display="none"}this.data.showing[a]=[]}};
+window.console=window.console||{log:function(a){}};window.googletag=window.googletag||{};googletag.cmd=googletag.cmd||[];window.Adgeletti={data:{positions:{},showing:{},displayed:{},single_request_enabled:false,lazy:{},media:{},matching:{},switch_scheduled:false,refreshing:{},refresh_timeout:null},options:{single_request:false,lazy_load:false,lazy_root_margin:'200px',min_refresh_interval:30,breakpoints:{}},configure:function(a){for(var b in a){if(a.hasOwnProperty(b)){this.options[b]=a[b];}}if(a.breakpoints){this.watch();}},watch:function(){var e=this;var b=this.options.breakpoints;var d=function(){e.scheduleSwitch();};if(!window.matchMedia){console.log('Media queries are not supported; breakpoints must be displayed manually');return;}for(var a in b){if(!b.hasOwnProperty(a)||this.data.media[a]){continue;}var c=this.data.media[a]=window.matchMedia(b[a]);if(c.addEventListener){c.addEventListener('change',d);}else{c.addListener(d);}}this.scheduleSwitch();},scheduleSwitch:function(){var a=this;var b=window.requestAnimationFrame||function(a){return setTimeout(a,16);};if(this.data.switch_scheduled){return;}this.data.switch_scheduled=true;b(function(){a.data.switch_scheduled=false;a.switchBreakpoints();});},switchBreakpoints:function(){var b=this.data.media;var c=this.data.matching;var a;for(a in b){if(b.hasOwnProperty(a)&&c[a]&&!b[a].matches){c[a]=false;this.hide(a);}}for(a in b){if(b.hasOwnProperty(a)&&!c[a]&&b[a].matches){c[a]=true;this.display(a);}}},position:function(b){var a=JSON.parse(b);this.addPosition(a.breakpoint,a.ad_unit_id,a.sizes,a.div_id,a.refresh);},load:function(b){if(b[0]!==1){console.log('Unsupported payload version '+b[0]);return;}var g=b[1];var i=b[2];var h=b[3];var e=b[4];for(var d=0; d<e.length;++d){var a=e[d];var f=[];for(var c=0; c<a[3].length;++c){f.push(h[a[3][c]]);}this.addPosition(i[a[0]],g?g+'/'+a[1]:a[1],f,'adgeletti-ad-div-'+a[2],a[4]);}},addPosition:function(a,f,b,e,c){var d=this.data.positions[a]=this.data.positions[a]||[];d.push({ad_unit_id:f,sizes:b,div_id:e,refresh:c||null});},display:function(b){console.log('Displaying ads for breakpoint "'+b+'"');var i=this.data.displayed;var d=this.data.showing[b]=this.data.showing[b]||{};var e=this.data.positions[b]||[];var g=[];var f=[];for(var c=0; c<e.length;++c){var a=e[c];var h=document.getElementById(a.div_id);if(!d.hasOwnProperty(a.div_id)){console.log('Showing ad div #'+a.div_id);h.style.display='block';d[a.div_id]=a;}if(i.hasOwnProperty(a.div_id)){console.log('Ad '+a.ad_unit_id+' already displayed for breakpoint "'+b+'"');continue;}i[a.div_id]=a;if(this.options.lazy_load&&h.getAttribute('data-adgeletti-lazy')!='false'){f.push(a);}else{g.push(a);}}this.fetch(g);this.observe(f);},fetch:function(a){var b=this;if(!a.length){return;}googletag.cmd.push(function(){var e=[];for(var c=0; c<a.length;++c){var d=a[c];if(b.options.single_request){e.push(b.defineSlot(d));continue;}console.log('Displaying ad '+d.ad_unit_id+' in div #'+d.div_id);googletag.pubads().display(d.ad_unit_id,d.sizes,d.div_id);}if(e.length){console.log('Fetching '+e.length+' ads');googletag.pubads().refresh(e);}for(var c=0; c<a.length;++c){if(a[c].refresh){b.scheduleRefresh(a[c]);}}});},scheduleRefresh:function(a){var b=this;a.refresh_interval=Math.max(a.refresh[0],this.options.min_refresh_interval);console.log('Refreshing ad div #'+a.div_id+' every '+a.refresh_interval+'s');a.refreshes=0;a.refresh_due=new Date().getTime()+a.refresh_interval*1000;this.data.refreshing[a.div_id]=a;if(!this.data.visibility_listening&&document.addEventListener){document.addEventListener('visibilitychange',function(){if(!document.hidden){b.refreshDue();}},false);this.data.visibility_listening=true;}this.startRefreshTimeout();},startRefreshTimeout:function(){var b=this;var a=null;if(this.data.refresh_timeout!==null){return;}for(var d in this.data.refreshing){if(this.data.refreshing.hasOwnProperty(d)){var c=this.data.refreshing[d].refresh_due;a=a===null?c:Math.min(a,c);}}if(a===null){return;}this.data.refresh_timeout=setTimeout(function(){b.data.refresh_timeout=null;b.refreshDue();},Math.max(a-new Date().getTime(),1000));},refreshDue:function(){var e=this;var d=new Date().getTime();var b=[];clearTimeout(this.data.refresh_timeout);this.data.refresh_timeout=null;if(document.hidden){return;}for(var c in this.data.refreshing){if(!this.data.refreshing.hasOwnProperty(c)){continue;}var a=this.data.refreshing[c];if(a.refresh_due>d||!this.isNear(document.getElementById(c),0)){continue;}b.push(a);a.refresh_due=d+a.refresh_interval*1000;if(++a.refreshes===a.refresh[1]){delete this.data.refreshing[c];}}if(b.length){googletag.cmd.push(function(){var a=[];for(var c=0; c<b.length;++c){var d=e.getSlot(b[c]);if(d){a.push(d);}}if(a.length){console.log('Refreshing '+a.length+' ads');googletag.pubads().refresh(a);}});}this.startRefreshTimeout();},getSlot:function(a){if(!a.slot){var c=googletag.pubads().getSlots();for(var b=0; b<c.length;++b){if(c[b].getSlotElementId()==a.div_id){a.slot=c[b];}}}return a.slot||null;},observe:function(b){var e=this;var c=this.data.lazy;if(!b.length){return;}for(var a=0; a<b.length;++a){console.log('Waiting for ad div #'+b[a].div_id+' to approach the viewport');c[b[a].div_id]=b[a];}if(window.IntersectionObserver){if(!this.data.observer){this.data.observer=new IntersectionObserver(function(d){var f=[];for(var a=0; a<d.length;++a){var b=d[a].target;if(d[a].isIntersecting&&c[b.id]){f.push(c[b.id]);delete c[b.id];e.data.observer.unobserve(b);}}e.fetch(f);},{rootMargin:this.options.lazy_root_margin});}for(var a=0; a<b.length;++a){this.data.observer.observe(document.getElementById(b[a].div_id));}return;}if(!this.data.lazy_listening&&window.addEventListener){var d=null;var f=function(){if(d===null){d=setTimeout(function(){d=null;e.fetchVisible();},100);}};window.addEventListener('scroll',f,false);window.addEventListener('resize',f,false);this.data.lazy_listening=true;}this.fetchVisible();},fetchVisible:function(){var c=parseInt(this.options.lazy_root_margin,10)||0;var b=[];for(var a in this.data.lazy){if(this.data.lazy.hasOwnProperty(a)&&this.isNear(document.getElementById(a),c)){b.push(this.data.lazy[a]);delete this.data.lazy[a];}}this.fetch(b);},isNear:function(c,b){if(c.style.display=='none'){return false;}var d=window.innerHeight||document.documentElement.clientHeight;var a=c.getBoundingClientRect();return a.top<d+b&&a.bottom>-b;},defineSlot:function(a){if(!this.data.single_request_enabled){googletag.pubads().enableSingleRequest();googletag.pubads().disableInitialLoad();googletag.enableServices();this.data.single_request_enabled=true;}console.log('Defining slot for ad '+a.ad_unit_id+' in div #'+a.div_id);a.slot=googletag.defineSlot(a.ad_unit_id,a.sizes,a.div_id).addService(googletag.pubads());googletag.display(a.div_id);return a.slot;},hide:function(b){console.log('Hiding ads for breakpoint "'+b+'"');var c=this.data.showing[b]||{};for(var a in c){if(c.hasOwnProperty(a)){console.log('Hiding ad div #'+a);document.getElementById(a).style.display='none';}}this.data.showing[b]={};}};
@@ -1,12 +1,20 @@
 import re
 import json
+import time
 import cStringIO
+from contextlib import contextmanager
 
 from django import template
+from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import connection
 from django.utils.html import escape
 
-from adgeletti.models import AdPosition
+from adgeletti import cache
+from adgeletti import devices
+from adgeletti import signals
+from adgeletti.conf import get_media_queries
+from adgeletti.models import AdPositionLookup
 
 
 register = template.Library()
@@ -14,6 +22,67 @@ register = template.Library()
 ADS = '_adgeletti_ads'
 FIRED = '_adgeletti_fired'
 BREAKPOINTS = '_adgeletti_breakpoints'
+EXCLUDED = '_adgeletti_excluded'
+SITE = '_adgeletti_site'
+CONFIG = '_adgeletti_config'
+
+# Prefix of the ids of ads' divs (see ``AdNode.div_id``)
+DIV_ID_PREFIX = u'adgeletti-ad-div-'
+
+# Version of the compact payload format (see ``compact_payload``)
+PAYLOAD_VERSION = 1
+STREAMED = '_adgeletti_streamed'
+# Context variable holding the positions preloaded for the page, if any (see
+# ``adgeletti.preload``)
+PRELOADED = 'adgeletti_preloaded'
+
+
+@contextmanager
+def instrument():
+    """Measures the block of a ``with`` statement, yielding a dictionary that
+    is then filled with the number of seconds it took ("duration") and the
+    number of queries it ran ("queries"), for the signals in
+    ``adgeletti.signals``.
+
+    Queries are counted by having the connection log them. Unless they were
+    logged anyway (e.g., as ``settings.DEBUG`` is ``True``), those logged by
+    the block are then discarded, as the log is only reset at the start of
+    each request, and would grow without bound when rendering outside of
+    requests (e.g., in tasks).
+    """
+    stats = {}
+    old_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    queries = len(connection.queries)
+    start = time.time()
+    try:
+        yield stats
+    finally:
+        stats['duration'] = time.time() - start
+        stats['queries'] = len(connection.queries) - queries
+        connection.use_debug_cursor = old_debug_cursor
+        if not (old_debug_cursor or settings.DEBUG):
+            del connection.queries[queries:]
+
+
+def is_deferred():
+    """Returns whether ``settings.ADGELETTI_DEFERRED`` is ``True``, in which
+    case ``{% adgeletti_go %}`` emits a placeholder listing the page's ads,
+    which ``adgeletti.middleware.PlaceholderMiddleware`` replaces with the
+    script defining their positions when the response is sent. This allows
+    pages to be cached in full, without the ad configuration in them.
+    """
+    return getattr(settings, 'ADGELETTI_DEFERRED', False)
+
+
+def is_streaming():
+    """Returns whether ``settings.ADGELETTI_STREAMING`` is ``True``, in which
+    case each ``{% ad ... %}`` tag emits the script defining its positions
+    along with their divs, rather than ``{% adgeletti_go %}`` emitting it for
+    all of them. This allows a page to be streamed, at the cost of requiring
+    adgeletti.js to be loaded before the first ad (e.g. in the page's head).
+    """
+    return getattr(settings, 'ADGELETTI_STREAMING', False)
 
 
 def error(text):
@@ -22,30 +91,216 @@ def error(text):
     return '<!-- %s -->\n' % escape(text)
 
 
+def get_excluded_breakpoints(context):
+    """Returns the set of breakpoints that can't apply to the device making the
+    request being rendered, if ``settings.ADGELETTI_PRUNE_BREAKPOINTS`` is
+    ``True`` (see ``adgeletti.devices``), for ``{% ad ... %}`` to skip.
+    """
+    request = context.get('request')
+    if request is None or not getattr(settings, 'ADGELETTI_PRUNE_BREAKPOINTS', False):
+        return set([])
+    return devices.get_excluded_breakpoints(request)
+
+
+def get_site(context):
+    """Returns the site being rendered, looking it up at most once per request.
+
+    If the context has a request with a ``site`` attribute (e.g., as set by a
+    middleware), that site is used. Otherwise, ``Site.objects.get_current()``
+    is used, and its result is memoized on the request, or on the render
+    context if the context has no request.
+    """
+    request = context.get('request')
+    if request is None:
+        memo = context.render_context
+        site = memo.get(SITE)
+        if site is None:
+            site = memo[SITE] = Site.objects.get_current()
+        return site
+    return get_request_site(request)
+
+
+def get_request_site(request):
+    """Returns the site of a request, as described in ``get_site``.
+    """
+    site = getattr(request, 'site', None)
+    if getattr(site, 'pk', None) is not None:
+        return site
+
+    site = getattr(request, SITE, None)
+    if site is None:
+        site = Site.objects.get_current()
+        setattr(request, SITE, site)
+    return site
+
+
+def get_positions(site, ads):
+    """Returns the data of each of the site's ad positions in the page, given
+    the page's ads as a dictionary of slot labels to dictionaries of
+    breakpoints to div ids. Each position's data is a dictionary with the keys
+    "breakpoint", "ad_unit_id", "sizes", and "div_id", and "refresh" for
+    positions that are refreshed periodically (see ``AdRefresh``).
+
+    Unless ``settings.ADGELETTI_CONFIG_CACHE`` is ``False``, the positions are
+    found in the site's cached configuration (see ``adgeletti.cache``), rather
+    than queried from the database.
+    """
+    if getattr(settings, 'ADGELETTI_CONFIG_CACHE', True):
+        return get_config_positions(cache.get_config(site.pk), ads)
+
+    positions = []
+    breakpoints = set([])
+    for divs in ads.values():
+        breakpoints.update(divs)
+
+    for pos in AdPositionLookup.objects.for_page(site, ads.keys(), breakpoints):
+        divs = ads[pos.label]
+        if pos.breakpoint in divs:
+            positions.append({
+                'breakpoint': pos.breakpoint,
+                'ad_unit_id': pos.ad_unit_id(),
+                'sizes': pos.size_list(),
+                'div_id': divs[pos.breakpoint],
+            })
+            if pos.refresh_interval is not None:
+                positions[-1]['refresh'] = pos.refresh_config()
+    return positions
+
+
+def get_config_positions(config, ads):
+    """Returns the data of the positions of the page's ads (see
+    ``get_positions``) found in a site's configuration (see
+    ``adgeletti.cache``).
+    """
+    positions = []
+    for slot, divs in ads.items():
+        slot_config = config.get(slot, {})
+        for breakpoint, div_id in divs.items():
+            if breakpoint in slot_config:
+                data = slot_config[breakpoint]
+                positions.append({
+                    'breakpoint': breakpoint,
+                    'ad_unit_id': data['ad_unit_id'],
+                    'sizes': data['sizes'],
+                    'div_id': div_id,
+                })
+                if 'refresh' in data:
+                    positions[-1]['refresh'] = data['refresh']
+    return positions
+
+
+def get_streamed_positions(context, ads):
+    """Returns the data of the positions of a tag's ads, when streaming (see
+    ``get_page_positions``). Without the cached configuration, the site's
+    configuration is loaded once per render, rather than once per tag.
+    """
+    if context.get(PRELOADED) is not None or getattr(settings, 'ADGELETTI_CONFIG_CACHE', True):
+        return get_page_positions(context, ads)
+    config = context.render_context.get(CONFIG)
+    if config is None:
+        config = context.render_context[CONFIG] = cache.build_config(get_site(context).pk)
+    return get_config_positions(config, ads)
+
+
+def get_page_positions(context, ads):
+    """Returns the data of the positions of the page's ads (see
+    ``get_positions``), from the positions preloaded in the context, if any
+    (see ``adgeletti.preload``), without querying the database.
+    """
+    preloaded = context.get(PRELOADED)
+    if preloaded is not None:
+        return preloaded.get_positions(ads)
+    return get_positions(get_site(context), ads)
+
+
 @register.tag(name='ad')
 def parse_ad(parser, token):
     """Parser for ad tag. Usage:
-        {% ad SLOT BREAKPOINT [BREAKPOINT ...] %}
+        {% ad SLOT BREAKPOINT [BREAKPOINT ...] [lazy=false] %}
+        {% ad slot=VARIABLE BREAKPOINT [BREAKPOINT ...] [lazy=false] %}
+
+    ``lazy=false`` causes the ad to be fetched as soon as its breakpoint is
+    displayed, even when ads are loaded lazily (see ``AdBlock.options``). With
+    ``slot=VARIABLE``, the slot's label is given by a template variable (with
+    optional filters), resolved when rendering.
     """
+    usage = u'usage: {% ad SLOT BREAKPOINT [BREAKPOINT ...] [lazy=false] %}'
     args = token.split_contents()
-
     if len(args) < 3:
-        raise template.TemplateSyntaxError(u'usage: {% ad SLOT BREAKPOINT [BREAKPOINT ...] %}')
+        raise template.TemplateSyntaxError(usage)
+
+    options = {}
+    while len(args) > 3 and '=' in args[-1]:
+        name, value = args.pop().split('=', 1)
+        if name != 'lazy' or value not in ('true', 'false'):
+            raise template.TemplateSyntaxError(u'invalid {%% ad %%} option: %s=%s' % (name, value))
+        options[name] = value == 'true'
+
+    if any('=' in arg for arg in args[2:]):
+        raise template.TemplateSyntaxError(usage)
 
     slot = args[1]
+    if slot.startswith('slot='):
+        slot = parser.compile_filter(slot[len('slot='):])
     breakpoints = args[2:]
-    return AdNode(slot, breakpoints)
+    return AdNode(slot, breakpoints, **options)
 
 
 class AdNode(template.Node):
-    """Emits a div with a unique id for each ad possible at the tag's location.
+    """Emits a div with a unique id for each ad possible at the tag's location
+    (followed by a script defining their positions, when streaming; see
+    ``is_streaming``).
     """
     _clean = re.compile(r'[^-_a-zA-Z0-9]')
     _replace = u'-'
-
-    def __init__(self, slot, breakpoints):
+    # Divs built for slots given as variables (see ``resolve``), keyed by
+    # slot, breakpoints and laziness
+    _built = cache.LRUCache(1024)
+
+    def __init__(self, slot, breakpoints, lazy=True):
+        """``slot`` is either the slot's label, or a ``FilterExpression``
+        resolving to it (or ``None``, for tags whose slot is resolved by
+        another template engine; see ``adgeletti.jinja_ext``). In the former
+        case, the tag's divs are built once, here.
+        """
         self.slot = slot
         self.breakpoints = breakpoints
+        self.lazy = lazy
+        self.divs = self.build_divs(slot) if isinstance(slot, basestring) else None
+
+    def build_divs(self, slot):
+        """Returns the breakpoint, div id (see ``div_id``) and div (see
+        ``build_div``) of each of the tag's ads, for the given slot.
+        """
+        divs = []
+        for breakpoint in self.breakpoints:
+            div_id = AdNode.div_id(slot, breakpoint)
+            divs.append((breakpoint, div_id, AdNode.build_div(div_id, self.lazy)))
+        return divs
+
+    def resolve(self, context):
+        """Returns the tag's slot, and its divs (see ``build_divs``). The divs
+        of slots given as variables are memoized, so that tags rendered
+        repeatedly (e.g., in loops) only build them once per slot. Variables
+        resolving to ``None`` (or another false value) give no slot.
+        """
+        if self.divs is not None:
+            return self.slot, self.divs
+        slot = self.slot.resolve(context)
+        return self.resolve_slot(unicode(slot) if slot else u'')
+
+    def resolve_slot(self, slot):
+        """Returns the given slot, resolved from a variable, and its divs,
+        building them only if they haven't been for that slot yet.
+        """
+        if not slot:
+            return slot, []
+        key = (slot, tuple(self.breakpoints), self.lazy)
+        divs = AdNode._built.get(key)
+        if divs is None:
+            divs = self.build_divs(slot)
+            AdNode._built.set(key, divs)
+        return slot, divs
 
     @staticmethod
     def clean_value(value):
@@ -59,47 +314,146 @@ class AdNode(template.Node):
         """Returns a string (unescaped) that may be used as the id attribute for
         an ad's div.
         """
-        return u'adgeletti-ad-div-%s-%s' % (slot, breakpoint)
+        return u'%s%s-%s' % (DIV_ID_PREFIX, slot, breakpoint)
 
     @staticmethod
-    def build_div(div_id):
-        """Builds an empty div into which an ad is to be placed.
+    def build_div(div_id, lazy=True):
+        """Builds an empty div into which an ad is to be placed. If ``lazy`` is
+        ``False``, the div opts its ad out of being loaded lazily.
         """
         div_id = AdNode.clean_value(div_id)
+        if not lazy:
+            return '<div class="adgeletti-ad-div" id="%s" style="display:none" data-adgeletti-lazy="false"></div>\n' % div_id
         return '<div class="adgeletti-ad-div" id="%s" style="display:none"></div>\n' % div_id
 
     def render(self, context):
+        slot, divs = self.resolve(context)
+        return self.render_ad(context, slot, divs)
+
+    def render_ad(self, context, slot, divs):
+        """Renders the tag for the given slot and divs (see ``resolve``),
+        sending ``signals.ad_rendered`` if it has receivers.
+        """
+        if not signals.ad_rendered.receivers:
+            return self.render_divs(context, slot, divs)
+
+        with instrument() as stats:
+            content = self.render_divs(context, slot, divs)
+        signals.ad_rendered.send(sender=AdNode, slot=slot, bytes=len(content.encode('utf-8')), **stats)
+        return content
+
+    def render_divs(self, context, slot, divs):
+        """Renders the tag (see ``render``), for the given slot and divs (see
+        ``resolve``). Nothing is rendered for slots given as variables that
+        resolve to an empty label.
+        """
         if context.render_context.get(FIRED, False):
             return error(u'{% ad ... %} used after {% adgeletti_go %} used')
 
+        if not slot:
+            return u''
+
         if ADS not in context.render_context:
             context.render_context[ADS] = {}
             context.render_context[FIRED] = False
             context.render_context[BREAKPOINTS] = set([])
+            context.render_context[STREAMED] = 0
+            context.render_context[EXCLUDED] = get_excluded_breakpoints(context)
 
-        if self.slot not in context.render_context[ADS]:
-            context.render_context[ADS][self.slot] = {}
+        if slot not in context.render_context[ADS]:
+            context.render_context[ADS][slot] = {}
 
         buf = cStringIO.StringIO()
+        added = {}
 
-        for breakpoint in self.breakpoints:
-            div_id = AdNode.div_id(self.slot, breakpoint)
-            div = AdNode.build_div(div_id)
+        excluded = context.render_context[EXCLUDED]
+        for breakpoint, div_id, div in divs:
+            if breakpoint in excluded:
+                continue
 
             # Add breakpoint to global set
             context.render_context[BREAKPOINTS].add(breakpoint)
 
             # Add to context and output
-            if breakpoint not in context.render_context[ADS][self.slot]:
-                context.render_context[ADS][self.slot][breakpoint] = div_id
+            if breakpoint not in context.render_context[ADS][slot]:
+                context.render_context[ADS][slot][breakpoint] = div_id
+                added[breakpoint] = div_id
                 buf.write(div)
 
+        if added and is_streaming():
+            positions = get_streamed_positions(context, {slot: added})
+            context.render_context[STREAMED] += len(positions)
+            if positions:
+                buf.write(u'<script type="text/javascript">\n')
+                write_positions(buf, positions)
+                buf.write(u'</script>\n')
+
         content = buf.getvalue()
         buf.close()
 
         return content
 
 
+def compact_payload(positions):
+    """Returns the data of the given positions (see ``get_positions``) in the
+    compact payload format loaded by `Adgeletti.load`, which is an array of:
+
+        - the format's version (``PAYLOAD_VERSION``)
+        - the DFP network ID, prefixed to each ad unit ID
+        - an array of breakpoints
+        - an array of sizes, as [width, height] pairs (arrays)
+        - an array of positions, as arrays of:
+            - the index of their breakpoint
+            - their ad unit ID, without the network ID
+            - their div's id, without ``DIV_ID_PREFIX``
+            - an array of the indexes of their sizes
+            - their refresh configuration, as an [interval, max_refreshes]
+              pair, for positions that are refreshed periodically only
+
+    If an ad unit ID doesn't start with the network ID, the network ID is
+    given as an empty string, and ad unit IDs are given in full.
+    """
+    network = settings.ADGELETTI_DFP_NETWORK_ID
+    prefix = u'%s/' % network
+    if not all(pos['ad_unit_id'].startswith(prefix) for pos in positions):
+        network, prefix = u'', u''
+
+    breakpoints, sizes, compact = {}, {}, []
+    for pos in positions:
+        breakpoint = breakpoints.setdefault(pos['breakpoint'], len(breakpoints))
+        size_indexes = [sizes.setdefault(tuple(size), len(sizes)) for size in pos['sizes']]
+        compact.append([breakpoint, pos['ad_unit_id'][len(prefix):], pos['div_id'][len(DIV_ID_PREFIX):], size_indexes])
+        if 'refresh' in pos:
+            compact[-1].append(pos['refresh'])
+
+    return [
+        PAYLOAD_VERSION,
+        network,
+        sorted(breakpoints, key=breakpoints.get),
+        [list(size) for size in sorted(sizes, key=sizes.get)],
+        compact,
+    ]
+
+
+def write_positions(buf, positions):
+    """Writes an `Adgeletti.position` call for each of the given positions (see
+    ``get_positions``) to ``buf``, providing the data as JSON. If
+    ``settings.ADGELETTI_COMPACT_PAYLOAD`` is ``True``, a single
+    `Adgeletti.load` call is written instead (see ``compact_payload``).
+    """
+    if getattr(settings, 'ADGELETTI_COMPACT_PAYLOAD', False):
+        data = json.dumps(compact_payload(positions), separators=(',', ':'))
+        # Keep the data from closing the script
+        data = data.replace(u'<', u'\\u003c').replace(u'>', u'\\u003e').replace(u'&', u'\\u0026')
+        buf.write(AdBlock.LOAD_TPL % (data,))
+        buf.write(u'\n')
+        return
+
+    for pos in positions:
+        buf.write(AdBlock.POSITION_TPL % (json.dumps(pos),))
+        buf.write(u'\n')
+
+
 @register.tag(name='adgeletti_go')
 def parse_adgeletti_go(parser, token):
     """Parser for adgeletti_go tag. Usage:
@@ -114,52 +468,202 @@ class AdBlock(template.Node):
 
         Adgeletti.position('{"breakpoint": "Mobile", "ad_unit_id": "AD-UNIT-ID-1", "div_id": "DIV-ID-1", "sizes": [[320,50]]}');
 
-    ...where sizes is an array of [width, height] pairs (arrays).
+    ...where sizes is an array of [width, height] pairs (arrays). If
+    ``settings.ADGELETTI_COMPACT_PAYLOAD`` is ``True``, all positions are
+    defined with a single `Adgeletti.load` call instead (see
+    ``compact_payload``).
+
+    Options set in ``settings`` (see ``AdBlock.options``) are passed to
+    ``Adgeletti.configure`` first. When streaming (see ``is_streaming``), the
+    positions have already been defined, so only the latter is emitted. When
+    deferred (see ``is_deferred``), a placeholder is emitted instead, to be
+    replaced with the script when the response is sent.
+
+    If ``settings.ADGELETTI_GPT_LOADER`` is ``True``, an async <script> tag
+    loading the GPT library (from ``settings.ADGELETTI_GPT_URL``, if set) is
+    emitted before it (see ``loader``).
     """
     # Template for ad definition
     POSITION_TPL = u'Adgeletti.position(\'%s\');'
+    # Template for ad definitions, in the compact payload format
+    LOAD_TPL = u'Adgeletti.load(%s);'
+    # Template for options
+    CONFIGURE_TPL = u'Adgeletti.configure(%s);'
+    # Template for the placeholder of the page's ads, and its pattern
+    PLACEHOLDER_TPL = u'<!--adgeletti:%s-->\n'
+    PLACEHOLDER_RE = re.compile(r'<!--adgeletti:(.*?)-->\n?')
+    # Template for loading the GPT library, and its default URL
+    LOADER_TPL = u'<script async src="%s"></script>\n'
+    GPT_URL = u'https://securepubads.g.doubleclick.net/tag/js/gpt.js'
+
+    @staticmethod
+    def loader():
+        """Returns the tag loading the GPT library asynchronously, if
+        ``settings.ADGELETTI_GPT_LOADER`` is ``True``. adgeletti.js queues its
+        calls to GPT on ``googletag.cmd`` until the library has loaded.
+        """
+        if not getattr(settings, 'ADGELETTI_GPT_LOADER', False):
+            return u''
+        return AdBlock.LOADER_TPL % (escape(getattr(settings, 'ADGELETTI_GPT_URL', AdBlock.GPT_URL)),)
+
+    @staticmethod
+    def options():
+        """Returns the options for adgeletti.js that differ from its defaults,
+        as set in ``settings``:
+
+        ``ADGELETTI_SINGLE_REQUEST``
+            Whether to fetch all of a breakpoint's ads with a single request.
+
+        ``ADGELETTI_LAZY_LOAD``
+            Whether to wait for the divs of ads to approach the viewport before
+            fetching them.
+
+        ``ADGELETTI_LAZY_ROOT_MARGIN``
+            How close to the viewport the divs of ads loaded lazily must be, as
+            a CSS margin around it (e.g. ``'200px'``, the default).
+
+        ``ADGELETTI_BREAKPOINTS``
+            The media queries of breakpoints given with one (see
+            ``adgeletti.conf.get_breakpoints``), which cause ads to be
+            displayed and hidden as the breakpoints start and stop matching.
+        """
+        options = {}
+        if getattr(settings, 'ADGELETTI_SINGLE_REQUEST', False):
+            options['single_request'] = True
+        if getattr(settings, 'ADGELETTI_LAZY_LOAD', False):
+            options['lazy_load'] = True
+            if hasattr(settings, 'ADGELETTI_LAZY_ROOT_MARGIN'):
+                options['lazy_root_margin'] = settings.ADGELETTI_LAZY_ROOT_MARGIN
+        media_queries = get_media_queries()
+        if media_queries:
+            options['breakpoints'] = media_queries
+        return options
 
     def render(self, context):
+        if not signals.block_rendered.receivers:
+            return self.render_block(context)[0]
+
+        with instrument() as stats:
+            content, positions, cache_hit = self.render_block(context)
+        signals.block_rendered.send(sender=AdBlock, positions=positions, cache_hit=cache_hit,
+                                    bytes=len(content.encode('utf-8')), **stats)
+        return content
+
+    def render_block(self, context):
+        """Renders the tag (see ``render``), returning the output, the number
+        of positions defined, and whether the output was memoized (``None`` if
+        it can't be).
+        """
         if ADS not in context.render_context or FIRED not in context.render_context:
-            return error(u'{% adgeletti_go %} was run without an {% ad ... %}')
+            return error(u'{% adgeletti_go %} was run without an {% ad ... %}'), 0, None
 
         if context.render_context[FIRED]:
-            return error(u'{% adgeletti_go %} called more than once')
+            return error(u'{% adgeletti_go %} called more than once'), 0, None
         else:
             context.render_context[FIRED] = True
 
-        # Start building output
-        buf = cStringIO.StringIO()
+        if is_streaming():
+            return AdBlock.render_bootstrap(context), context.render_context[STREAMED], None
 
-        # Get database data
-        slots = context.render_context[ADS].keys()
-        breakpoints = context.render_context[BREAKPOINTS]
-        positions = AdPosition.objects.filter(
-            slot__site=Site.objects.get_current(),
-            slot__label__in=slots,
-            breakpoint__in=breakpoints,
-        )
+        ads = context.render_context[ADS]
+        if is_deferred():
+            return AdBlock.render_placeholder(ads), 0, None
 
-        if slots and not positions:
+        if context.get(PRELOADED) is not None:
+            return AdBlock.render_positions(ads, get_page_positions(context, ads)) + (None,)
+
+        return AdBlock.render_payload(get_site(context), ads)
+
+    @staticmethod
+    def render_payload(site, ads):
+        """Builds the script defining the site's positions for the page's ads
+        (see ``render_positions``), returning it, the number of positions, and
+        whether it was memoized (``None`` if it can't be).
+        """
+        if not getattr(settings, 'ADGELETTI_CONFIG_CACHE', True):
+            return AdBlock.render_positions(ads, get_positions(site, ads)) + (None,)
+
+        # The output only depends on the site's configuration and the page's
+        # ads, so it is memoized for the current generation of the former
+        key = (site.pk, cache.get_generation(), frozenset(
+            (slot, breakpoint, div_id) for slot, divs in ads.items() for breakpoint, div_id in divs.items()
+        ))
+        payload = cache.payloads.get(key)
+        if payload is not None:
+            return payload + (True,)
+
+        payload = AdBlock.render_positions(ads, get_positions(site, ads))
+        cache.payloads.set(key, payload)
+        return payload + (False,)
+
+    @staticmethod
+    def render_placeholder(ads):
+        """Builds the placeholder for the page's ads (see ``is_deferred``): an
+        HTML comment holding a JSON object of the breakpoints of each slot.
+        """
+        data = json.dumps(dict((slot, sorted(divs)) for slot, divs in ads.items()), sort_keys=True, separators=(',', ':'))
+        # The comment mustn't be closed early
+        data = data.replace(u'-', u'\\u002d').replace(u'>', u'\\u003e')
+        return AdBlock.PLACEHOLDER_TPL % (data,)
+
+    @staticmethod
+    def fill_placeholders(content, site):
+        """Replaces the placeholders in the given content (see
+        ``render_placeholder``) with the scripts defining the site's positions
+        for their ads.
+        """
+        def replace(match):
+            try:
+                slots = json.loads(match.group(1))
+                ads = dict((slot, dict((bp, AdNode.div_id(slot, bp)) for bp in breakpoints))
+                           for slot, breakpoints in slots.items())
+            except (ValueError, AttributeError, TypeError):
+                return error(u'Invalid placeholder')
+            return AdBlock.render_payload(site, ads)[0]
+        return AdBlock.PLACEHOLDER_RE.sub(replace, content)
+
+    @staticmethod
+    def render_bootstrap(context):
+        """Builds the script passing options to adgeletti.js, once ``{% ad ... %}``
+        tags have defined the page's positions themselves.
+        """
+        if not context.render_context[STREAMED]:
+            slots = context.render_context[ADS].keys()
             return error(u'No ad positions exist for the slots in the page (slots: %s)' % slots)
 
+        options = AdBlock.options()
+        if not options:
+            return AdBlock.loader()
+
+        return AdBlock.loader() + u'<script type="text/javascript">\n%s\n</script>\n' % (AdBlock.CONFIGURE_TPL % (json.dumps(options),))
+
+    @staticmethod
+    def render_positions(ads, positions):
+        """Builds the script defining the given positions of the page's ads
+        (see ``get_positions``), returning it and the number of positions.
+        """
+        slots = ads.keys()
+        if slots and not positions:
+            return error(u'No ad positions exist for the slots in the page (slots: %s)' % slots), 0
+
+        # Start building output
+        buf = cStringIO.StringIO()
+
         # Always output script and base data structure
+        buf.write(AdBlock.loader())
         buf.write(u'<script type="text/javascript">\n')
 
+        options = AdBlock.options()
+        if options:
+            buf.write(AdBlock.CONFIGURE_TPL % (json.dumps(options),))
+            buf.write(u'\n')
+
         # Loop through each ``AdPosition`` and emit an `Adgeletti.position`
         # call for each, providing the data as JSON
-        for pos in positions:
-            _position_data = {
-                'breakpoint': pos.breakpoint,
-                'ad_unit_id': pos.slot.ad_unit_id(),
-                'sizes': [[size.width, size.height] for size in pos.sizes.all()],
-                'div_id': context.render_context[ADS][pos.slot.label][pos.breakpoint],
-            }
-            buf.write(AdBlock.POSITION_TPL % (json.dumps(_position_data),))
-            buf.write(u'\n')
+        write_positions(buf, positions)
 
         buf.write(u'</script>\n')
         content = buf.getvalue()
         buf.close()
 
-        return content
+        return content, len(positions)
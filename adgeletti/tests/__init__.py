@@ -1,2 +1,44 @@
+import mock
+from django.contrib.sites.models import Site
+from django.core.cache import cache as django_cache
+from django.test import TestCase
+from adgeletti import cache
+from adgeletti.models import Size, AdSlot, AdPosition
+
+
+class AdTestCase(TestCase):
+    """Base class of tests needing ad configuration: a site, with a slot
+    having a position for a breakpoint, allowing a 300x250 size. Adgeletti's
+    caches are cleared beforehand.
+    """
+    slot_label = 'SLOT'
+    breakpoint = 'A'
+
+    def setUp(self):
+        django_cache.clear()
+        cache._snapshots.clear()
+        cache.payloads.clear()
+
+        self.site = self.create_site()
+        self.size = Size.objects.create(width=300, height=250)
+        self.slot = AdSlot.objects.create(label=self.slot_label, ad_unit='ADUNIT', site=self.site)
+        self.pos = AdPosition.objects.create(slot=self.slot, breakpoint=self.breakpoint)
+        self.pos.sizes.add(self.size)
+        # As if committed
+        cache.flush_invalidation()
+        self.request = mock.Mock(site=self.site)
+
+    def create_site(self):
+        return Site.objects.create(name='SITE', domain='example.com')
+
+
+from adgeletti.tests.test_benchmarks import *
+from adgeletti.tests.test_cache import *
+from adgeletti.tests.test_conf import *
+from adgeletti.tests.test_devices import *
+from adgeletti.tests.test_importer import *
+from adgeletti.tests.test_jinja import *
 from adgeletti.tests.test_models import *
+from adgeletti.tests.test_preload import *
 from adgeletti.tests.test_tags import *
+from adgeletti.tests.test_views import *
@@ -0,0 +1,44 @@
+from django.core.cache import cache as django_cache
+from django.test import TestCase
+from adgeletti import benchmarks, cache
+
+
+class BenchmarksTestCase(TestCase):
+    def setUp(self):
+        django_cache.clear()
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(benchmarks.percentile(values, 50), 50)
+        self.assertEqual(benchmarks.percentile(values, 99), 99)
+        self.assertEqual(benchmarks.percentile([3], 90), 3)
+
+    def test_private_cache(self):
+        generation = cache.get_generation()
+        cache.payloads.set('key', 'payload')
+        with benchmarks.private_cache():
+            self.assertIsNot(cache.django_cache, django_cache)
+            self.assertIsNone(cache.payloads.get('key'))
+            benchmarks.create_config(slots=1, breakpoints=1, sizes=1)
+        self.assertIs(cache.django_cache, django_cache)
+        self.assertEqual(cache.get_generation(), generation)
+
+    def test_run_scenario(self):
+        result = benchmarks.run_scenario(slots=3, breakpoints=2, sizes=2, iterations=5)
+        self.assertEqual(result['iterations'], 5)
+        self.assertTrue(result['cached'])
+        self.assertEqual(result['queries'], {'cold': 1, 'mean': 0.0})
+        self.assertEqual(set(result['latency_ms']), set(['cold', 'p50', 'p90', 'p99', 'max']))
+        self.assertTrue(result['allocated_bytes'] > result['output_bytes'])
+        self.assertIn(result['allocation_method'], ('tracemalloc', 'census'))
+
+    def test_run_scenario_uncached(self):
+        result = benchmarks.run_scenario(slots=3, breakpoints=2, sizes=2, iterations=5, cached=False)
+        self.assertEqual(result['queries'], {'cold': 1, 'mean': 1.0})
+        self.assertTrue(result['output_bytes'] > 0)
+
+    def test_census_allocations(self):
+        site, source = benchmarks.create_config(slots=3, breakpoints=2, sizes=2)
+        tpl = benchmarks.template.Template(source)
+        context = benchmarks.template.Context({'request': benchmarks.BenchmarkRequest(site)})
+        self.assertTrue(benchmarks.census_allocations(tpl, context) > len(tpl.render(context)))
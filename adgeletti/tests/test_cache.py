@@ -0,0 +1,232 @@
+import os
+import json
+import mock
+import time
+import tempfile
+import cStringIO
+from django.conf import settings
+from django.core import signals
+from django.core.cache import cache as django_cache, get_cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from adgeletti import cache
+from adgeletti.models import Size, AdRefresh
+from adgeletti.tests import AdTestCase
+
+
+class ConfigCacheTestCase(AdTestCase):
+    def test_build_config(self):
+        config = cache.build_config(self.site.pk)
+        self.assertEqual(config, {
+            'SLOT': {
+                'A': {'ad_unit_id': '%s/ADUNIT' % settings.ADGELETTI_DFP_NETWORK_ID, 'sizes': [[300, 250]]},
+            },
+        })
+
+    def test_refresh(self):
+        refresh = AdRefresh.objects.create(position=self.pos, interval=30, max_refreshes=5)
+        self.assertEqual(cache.get_config(self.site.pk)['SLOT']['A']['refresh'], [30, 5])
+        refresh.delete()
+        self.assertNotIn('refresh', cache.get_config(self.site.pk)['SLOT']['A'])
+
+    def test_get_config_cached(self):
+        with self.assertNumQueries(1):
+            config = cache.get_config(self.site.pk)
+        with self.assertNumQueries(0):
+            self.assertIs(cache.get_config(self.site.pk), config)
+
+    def test_invalidate_on_save(self):
+        cache.get_config(self.site.pk)
+        generation = cache.get_generation()
+
+        self.slot.ad_unit = 'OTHER'
+        self.slot.save()
+        self.assertEqual(cache.get_config(self.site.pk)['SLOT']['A']['ad_unit_id'], '%s/OTHER' % settings.ADGELETTI_DFP_NETWORK_ID)
+        # Other processes aren't told until the transaction is committed
+        self.assertEqual(cache.get_generation(), generation)
+        signals.request_finished.send(sender=None)
+        self.assertNotEqual(cache.get_generation(), generation)
+
+    def test_invalidate_unmanaged(self):
+        generation = cache.get_generation()
+        with mock.patch('django.db.transaction.is_managed', return_value=False):
+            self.slot.save()
+        self.assertNotEqual(cache.get_generation(), generation)
+
+    def test_invalidate_on_sizes_changed(self):
+        cache.get_config(self.site.pk)
+        self.pos.sizes.add(Size.objects.create(width=728, height=90))
+        self.assertItemsEqual(cache.get_config(self.site.pk)['SLOT']['A']['sizes'], [[300, 250], [728, 90]])
+
+    def test_invalidate_on_delete(self):
+        cache.get_config(self.site.pk)
+        self.pos.delete()
+        self.assertEqual(cache.get_config(self.site.pk), {})
+
+    def test_stale_generation(self):
+        # Another process bumping the generation makes this process' snapshot
+        # stale, without its signal handlers having been run
+        config = cache.get_config(self.site.pk)
+        cache.bump_generation()
+        with self.assertNumQueries(1):
+            self.assertIsNot(cache.get_config(self.site.pk), config)
+
+
+    @mock.patch('adgeletti.cache.django_cache', get_cache('django.core.cache.backends.locmem.LocMemCache', TIMEOUT=1))
+    def test_generation_does_not_expire(self):
+        # The generation outlives the backend's default timeout
+        generation = cache.get_generation()
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(cache.get_generation(), generation)
+        cache.bump_generation()
+        generation = cache.get_generation()
+        with mock.patch('time.time', return_value=time.time() + 3600):
+            self.assertEqual(cache.get_generation(), generation)
+
+    @override_settings(ADGELETTI_GENERATION_TIMEOUT=60)
+    def test_generation_timeout(self):
+        with mock.patch.object(django_cache, 'set') as set:
+            cache.bump_generation()
+        self.assertEqual(set.call_args[0][2], 60)
+
+@override_settings(ADGELETTI_SHARED_CONFIG_CACHE=True)
+class SharedConfigCacheTestCase(AdTestCase):
+    def setUp(self):
+        super(SharedConfigCacheTestCase, self).setUp()
+        self.key = cache.CONFIG_KEY % (self.site.pk, cache.get_generation())
+
+    def test_stored(self):
+        config = cache.get_config(self.site.pk)
+        self.assertEqual(json.loads(django_cache.get(self.key)), config)
+        self.assertIsNone(django_cache.get(self.key + ':lock'))
+
+    def test_loaded_from_shared_cache(self):
+        config = cache.get_config(self.site.pk)
+        # Simulate another process, which has no snapshot
+        cache._snapshots.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(cache.get_config(self.site.pk), config)
+
+    def test_locked(self):
+        django_cache.add(self.key + ':lock', 1)
+        with mock.patch.multiple(cache, LOCK_TIMEOUT=0.1, LOCK_WAIT=0.01):
+            # Another process holds the lock and never stores the config
+            config = cache.get_config(self.site.pk)
+        self.assertIn('SLOT', config)
+        self.assertIsNone(django_cache.get(self.key))
+
+
+class SnapshotTestCase(AdTestCase):
+    def setUp(self):
+        super(SnapshotTestCase, self).setUp()
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+        cache._snapshot_file_loaded = False
+
+    def write(self):
+        call_command('adgeletti_snapshot', self.path, stdout=cStringIO.StringIO())
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return cache.read_snapshot(f)
+
+    def test_roundtrip(self):
+        self.write()
+        snapshot = self.read()
+        self.assertEqual(snapshot['generation'], cache.get_generation())
+        self.assertEqual(snapshot['configs'][self.site.pk], cache.build_config(self.site.pk))
+
+    def test_checksum_ignores_size_order(self):
+        configs = {1: {'SLOT': {'A': {'ad_unit_id': 'X', 'sizes': [[1, 2], [3, 4]]}}}}
+        reordered = {1: {'SLOT': {'A': {'ad_unit_id': 'X', 'sizes': [[3, 4], [1, 2]]}}}}
+        self.assertEqual(cache.checksum(configs), cache.checksum(reordered))
+
+    def test_invalid_checksum(self):
+        snapshot = cache.export_snapshot()
+        snapshot['configs'][self.site.pk]['SLOT']['A']['ad_unit_id'] = 'OTHER'
+        f = cStringIO.StringIO()
+        cache.write_snapshot(f, snapshot)
+        f.seek(0)
+        self.assertRaises(cache.SnapshotError, cache.read_snapshot, f)
+
+    def start_process(self):
+        # The state of a new process, sharing the cache of the one that
+        # exported the snapshot, as it imports ``adgeletti.models``
+        cache._snapshots.clear()
+        cache.payloads.clear()
+        cache._snapshot_file_loaded = False
+        with override_settings(ADGELETTI_SNAPSHOT_FILE=self.path):
+            cache.load_snapshot_file()
+
+    def test_loaded_from_file(self):
+        self.write()
+        self.start_process()
+        with self.assertNumQueries(0):
+            self.assertIn('SLOT', cache.get_config(self.site.pk))
+
+    def test_loaded_once(self):
+        self.write()
+        self.start_process()
+        with override_settings(ADGELETTI_SNAPSHOT_FILE=self.path):
+            with mock.patch.object(cache, 'read_snapshot') as read_snapshot:
+                cache.load_snapshot_file()
+        self.assertFalse(read_snapshot.called)
+
+    def test_stale_file_ignored(self):
+        self.write()
+        self.pos.sizes.add(Size.objects.create(width=728, height=90))
+        cache.flush_invalidation()
+        with mock.patch.object(cache, 'logger') as logger:
+            self.start_process()
+        self.assertTrue(logger.warning.called)
+        with self.assertNumQueries(1):
+            self.assertEqual(len(cache.get_config(self.site.pk)['SLOT']['A']['sizes']), 2)
+
+    def test_cleared_cache_ignored(self):
+        # Without the generation it was exported at, the snapshot can't be
+        # told from a stale one
+        self.write()
+        django_cache.clear()
+        with mock.patch.object(cache, 'logger') as logger:
+            self.start_process()
+        self.assertTrue(logger.warning.called)
+        self.assertEqual(cache._snapshots, {})
+
+    def test_check(self):
+        self.write()
+        call_command('adgeletti_snapshot', self.path, check=True, stdout=cStringIO.StringIO())
+        self.pos.delete()
+        # Errors exit when raised by ``call_command``
+        self.assertRaises(SystemExit, call_command, 'adgeletti_snapshot', self.path, check=True, stderr=cStringIO.StringIO())
+
+
+class LRUCacheTestCase(TestCase):
+    def test_get_set(self):
+        lru = cache.LRUCache(2)
+        self.assertIsNone(lru.get('a'))
+        lru.set('a', 1)
+        lru.set('a', 2)
+        self.assertEqual(lru.get('a'), 2)
+        self.assertEqual(len(lru), 1)
+
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        lru.get('a')
+        lru.set('c', 3)
+        self.assertEqual(len(lru), 2)
+        self.assertEqual(lru.get('a'), 1)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual(lru.get('c'), 3)
+
+    def test_clear(self):
+        lru = cache.LRUCache(2)
+        lru.set('a', 1)
+        lru.clear()
+        self.assertEqual(len(lru), 0)
+        self.assertIsNone(lru.get('a'))
@@ -0,0 +1,13 @@
+from django.test.utils import override_settings
+from django.utils.unittest import TestCase
+from adgeletti import conf
+
+
+class BreakpointsTestCase(TestCase):
+    @override_settings(ADGELETTI_BREAKPOINTS=['Mobile', ('Wide', '(min-width: 1024px)')])
+    def test_get_breakpoints(self):
+        self.assertEqual(conf.get_breakpoints(), [('Mobile', None), ('Wide', '(min-width: 1024px)')])
+
+    @override_settings(ADGELETTI_BREAKPOINTS=['Mobile', ('Wide', '(min-width: 1024px)')])
+    def test_get_media_queries(self):
+        self.assertEqual(conf.get_media_queries(), {'Wide': '(min-width: 1024px)'})
@@ -0,0 +1,76 @@
+import mock
+from django.http import HttpRequest, HttpResponse
+from django.test.utils import override_settings
+from django.utils.unittest import TestCase
+from adgeletti import devices
+from adgeletti.middleware import ClientHintsMiddleware
+
+
+BREAKPOINTS = [
+    ('Mobile', '(max-width: 767px)'),
+    ('Tablet', 'only screen and (min-width: 768px) and (max-width: 1023px)'),
+    ('Desktop', '(min-width: 64em)'),
+    ('Landscape', '(orientation: landscape)'),
+    'Print',
+]
+
+
+def classify_as_desktop(user_agent):
+    return (1024, None)
+
+
+class ParseWidthsTestCase(TestCase):
+    def test_parse_widths(self):
+        self.assertEqual(devices.parse_widths('(max-width: 767px)'), (None, 767))
+        self.assertEqual(devices.parse_widths('screen and (min-width:768px) and (max-width: 1023.98px)'), (768, 1023.98))
+        self.assertEqual(devices.parse_widths('(min-width: 64em)'), (1024, None))
+
+    def test_unsupported(self):
+        self.assertIsNone(devices.parse_widths('(orientation: landscape)'))
+        self.assertIsNone(devices.parse_widths('print and (min-width: 768px)'))
+        self.assertIsNone(devices.parse_widths('(max-width: 767px), (min-width: 1024px)'))
+
+
+@override_settings(ADGELETTI_BREAKPOINTS=BREAKPOINTS)
+class ExcludedBreakpointsTestCase(TestCase):
+    def setUp(self):
+        devices._classified.clear()
+
+    def request(self, **meta):
+        request = HttpRequest()
+        request.META.update(meta)
+        return request
+
+    def test_viewport_width(self):
+        request = self.request(HTTP_SEC_CH_VIEWPORT_WIDTH='800', HTTP_USER_AGENT='Mobile Safari')
+        self.assertEqual(devices.get_excluded_breakpoints(request), set(['Mobile', 'Desktop']))
+
+    def test_mobile_hint(self):
+        request = self.request(HTTP_SEC_CH_UA_MOBILE='?1')
+        self.assertEqual(devices.get_excluded_breakpoints(request), set(['Desktop']))
+
+    def test_user_agent(self):
+        request = self.request(HTTP_USER_AGENT='Mozilla/5.0 (iPhone) Mobile/15E148 Safari/604.1')
+        self.assertEqual(devices.get_excluded_breakpoints(request), set(['Desktop']))
+
+    def test_unsure(self):
+        self.assertEqual(devices.get_excluded_breakpoints(self.request()), set([]))
+        request = self.request(HTTP_USER_AGENT='Mozilla/5.0 (iPad) Mobile/15E148', HTTP_SEC_CH_VIEWPORT_WIDTH='wide')
+        self.assertEqual(devices.get_excluded_breakpoints(request), set([]))
+
+    @override_settings(ADGELETTI_DEVICE_CLASSIFIER='adgeletti.tests.test_devices.classify_as_desktop')
+    def test_classifier_memoized(self):
+        request = self.request(HTTP_USER_AGENT='Desktop')
+        with mock.patch('adgeletti.tests.test_devices.classify_as_desktop', return_value=(1024, None)) as classify:
+            self.assertEqual(devices.get_excluded_breakpoints(request), set(['Mobile', 'Tablet']))
+            self.assertEqual(devices.get_excluded_breakpoints(request), set(['Mobile', 'Tablet']))
+        self.assertEqual(classify.call_count, 1)
+
+
+class ClientHintsMiddlewareTestCase(TestCase):
+    def test_process_response(self):
+        response = HttpResponse()
+        response['Accept-CH'] = 'DPR'
+        response = ClientHintsMiddleware().process_response(HttpRequest(), response)
+        self.assertEqual(response['Accept-CH'], 'DPR, Sec-CH-Viewport-Width, Viewport-Width, Sec-CH-UA-Mobile')
+        self.assertIn('User-Agent', response['Vary'])
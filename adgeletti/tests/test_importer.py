@@ -0,0 +1,113 @@
+import json
+import cStringIO
+from django.contrib.sites.models import Site
+from django.core.cache import cache as django_cache
+from django.test import TestCase
+from adgeletti import cache, importer
+from adgeletti.models import Size, AdSlot
+
+
+class ImporterTestCase(TestCase):
+    def setUp(self):
+        django_cache.clear()
+        self.site = Site.objects.create(name='SITE', domain='ads.example.com')
+        self.manifest = [
+            {'site': 'ads.example.com', 'label': 'SLOT1', 'ad_unit': 'UNIT1',
+             'positions': {'mobile': [[320, 50]], 'default': [[728, 90], [300, 250]]}},
+            {'site': self.site.pk, 'label': 'SLOT2', 'ad_unit': 'UNIT2',
+             'positions': {'mobile': [[320, 50]]}},
+        ]
+
+    def run_import(self, **kwargs):
+        entries = importer.read_json(cStringIO.StringIO(json.dumps(self.manifest)))
+        return importer.import_manifest(entries, **kwargs)
+
+    def config(self):
+        config = cache.build_config(self.site.pk)
+        return dict((label, dict((bp, (data['ad_unit_id'].split('/', 1)[1], sorted(data['sizes'])))
+                                 for bp, data in positions.items()))
+                    for label, positions in config.items())
+
+    def test_import(self):
+        diff = self.run_import()
+        self.assertEqual(diff.counts(), {
+            'sizes_created': 3, 'slots_created': 2, 'slots_updated': 0, 'slots_deleted': 0,
+            'positions_created': 3, 'positions_deleted': 0, 'sizes_added': 4, 'sizes_removed': 0,
+        })
+        self.assertEqual(self.config(), {
+            'SLOT1': {'mobile': ('UNIT1', [[320, 50]]), 'default': ('UNIT1', [[300, 250], [728, 90]])},
+            'SLOT2': {'mobile': ('UNIT2', [[320, 50]])},
+        })
+
+    def test_query_count(self):
+        # The number of queries doesn't depend on the number of rows
+        self.manifest.extend(
+            {'site': self.site.pk, 'label': 'MANY%d' % i, 'ad_unit': 'UNIT', 'positions': {'mobile': [[320, 50]]}}
+            for i in range(20)
+        )
+        with self.assertNumQueries(16):
+            self.run_import()
+
+    def test_reimport(self):
+        self.run_import()
+        generation = cache.get_generation()
+        diff = self.run_import()
+        self.assertFalse(diff)
+        self.assertEqual(cache.get_generation(), generation)
+
+    def test_update(self):
+        self.run_import()
+        self.manifest[0]['ad_unit'] = 'OTHER'
+        self.manifest[0]['positions']['default'] = [[300, 250], [160, 600]]
+        generation = cache.get_generation()
+
+        diff = self.run_import()
+        self.assertEqual(diff.slots_updated, [(self.site.pk, 'SLOT1')])
+        self.assertEqual(diff.sizes_created, [(160, 600)])
+        self.assertEqual(diff.sizes_added, [((self.site.pk, 'SLOT1', 'default'), (160, 600))])
+        self.assertEqual(diff.sizes_removed, [((self.site.pk, 'SLOT1', 'default'), (728, 90))])
+        self.assertEqual(self.config()['SLOT1']['default'], ('OTHER', [[160, 600], [300, 250]]))
+        self.assertNotEqual(cache.get_generation(), generation)
+
+    def test_prune(self):
+        self.run_import()
+        del self.manifest[1]
+        del self.manifest[0]['positions']['mobile']
+
+        diff = self.run_import()
+        self.assertEqual(diff.slots_deleted, [])
+        self.assertEqual(self.config()['SLOT2']['mobile'], ('UNIT2', [[320, 50]]))
+
+        diff = self.run_import(prune=True)
+        self.assertEqual(diff.slots_deleted, [(self.site.pk, 'SLOT2')])
+        self.assertEqual(diff.positions_deleted, [(self.site.pk, 'SLOT1', 'mobile')])
+        self.assertEqual(self.config(), {'SLOT1': {'default': ('UNIT1', [[300, 250], [728, 90]])}})
+
+    def test_dry_run(self):
+        diff = self.run_import(dry_run=True)
+        self.assertEqual(len(diff.slots_created), 2)
+        self.assertEqual(AdSlot.objects.count(), 0)
+        self.assertEqual(Size.objects.count(), 0)
+
+    def test_read_csv(self):
+        f = cStringIO.StringIO(
+            'site,label,ad_unit,breakpoint,sizes\n'
+            'ads.example.com,SLOT1,UNIT1,mobile,320x50\n'
+            'ads.example.com,SLOT1,UNIT1,default,728x90 300x250\n'
+            '%d,SLOT2,UNIT2,,\n' % self.site.pk
+        )
+        importer.import_manifest(importer.read_csv(f))
+        self.assertEqual(self.config(), {
+            'SLOT1': {'mobile': ('UNIT1', [[320, 50]]), 'default': ('UNIT1', [[300, 250], [728, 90]])},
+        })
+        self.assertEqual(AdSlot.objects.get(label='SLOT2').ad_unit, 'UNIT2')
+
+    def test_invalid(self):
+        self.manifest[0]['site'] = 'unknown.example.com'
+        self.assertRaises(importer.ManifestError, self.run_import)
+
+        self.manifest[0]['site'] = self.site.pk
+        self.manifest[0]['positions']['unknown'] = []
+        self.assertRaises(importer.ManifestError, self.run_import)
+
+        self.assertRaises(importer.ManifestError, importer.parse_size, '300by250')
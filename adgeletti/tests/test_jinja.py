@@ -0,0 +1,81 @@
+import mock
+import shutil
+import tempfile
+from adgeletti.models import AdSlot, AdPosition
+from adgeletti.tests import AdTestCase
+from adgeletti.templatetags import adgeletti_tags as tags
+from django import template
+from django.utils.unittest import skipIf
+
+try:
+    import jinja2
+    from adgeletti import jinja_ext
+except ImportError:
+    jinja2 = None
+
+
+@skipIf(jinja2 is None, 'Jinja2 is not installed')
+class JinjaExtensionTestCase(AdTestCase):
+    slot_label = 'SLOT1'
+
+    def setUp(self):
+        super(JinjaExtensionTestCase, self).setUp()
+        slot = AdSlot.objects.create(label='SLOT2', ad_unit='ADUNIT', site=self.site)
+        AdPosition.objects.create(slot=slot, breakpoint='A').sizes.add(self.size)
+        self.env = jinja2.Environment(extensions=[jinja_ext.AdgelettiExtension], autoescape=True)
+
+    def render_django(self, source):
+        tpl = template.Template('{% load adgeletti_tags %}' + source)
+        return tpl.render(template.Context({'request': self.request, 'labels': ['SLOT2', 'SLOT2', '', None]}))
+
+    def render_jinja(self, source):
+        return self.env.from_string(source).render(request=self.request, labels=['SLOT2', 'SLOT2', '', None])
+
+    def test_same_output(self):
+        result = self.render_jinja('{% ad "SLOT1" A B lazy=false %}{% for label in labels %}{% ad label A %}{% endfor %}{% adgeletti_go %}')
+        self.assertEqual(
+            result,
+            self.render_django('{% ad SLOT1 A B lazy=false %}{% for label in labels %}{% ad slot=label A %}{% endfor %}{% adgeletti_go %}'),
+        )
+        self.assertNotIn(tags.AdNode.div_id('None', 'A'), result)
+
+    def test_divs_built_at_load(self):
+        tpl = self.env.from_string('{% ad "SLOT1" A %}')
+        with mock.patch.object(tags.AdNode, 'build_div') as build_div:
+            tpl.render(request=self.request)
+        self.assertFalse(build_div.called)
+
+    def test_state_shared_with_includes(self):
+        self.env.loader = jinja2.DictLoader({'ad.html': '{% ad "SLOT2" A %}'})
+        result = self.render_jinja('{% set _adgeletti = {} %}{% include "ad.html" %}{% adgeletti_go %}')
+        self.assertIn('"div_id": "%s"' % tags.AdNode.div_id('SLOT2', 'A'), result)
+
+    def test_bytecode_cache(self):
+        # Templates loaded from compiled code, in an environment that hasn't
+        # compiled them, render their own ads
+        loader = jinja2.DictLoader({
+            'a.html': '{% ad "SLOT1" A %}{% adgeletti_go %}',
+            'b.html': '{% ad "SLOT2" A lazy=false %}{% adgeletti_go %}',
+        })
+        path = tempfile.mkdtemp()
+        try:
+            def environment():
+                return jinja2.Environment(extensions=[jinja_ext.AdgelettiExtension], autoescape=True, loader=loader,
+                                          bytecode_cache=jinja2.FileSystemBytecodeCache(path))
+            expected = environment().get_template('a.html').render(request=self.request)
+            environment().get_template('b.html')
+
+            env = environment()
+            env.get_template('b.html')
+            with mock.patch.object(env, 'compile') as compile:
+                result = env.get_template('a.html').render(request=self.request)
+            self.assertFalse(compile.called)
+            self.assertEqual(result, expected)
+            self.assertIn(tags.AdNode.div_id('SLOT1', 'A'), result)
+        finally:
+            shutil.rmtree(path)
+
+    def test_errors(self):
+        self.assertRaises(jinja2.TemplateSyntaxError, self.env.from_string, '{% ad "SLOT1" %}')
+        self.assertRaises(jinja2.TemplateSyntaxError, self.env.from_string, '{% ad "SLOT1" A lazy=no %}')
+        self.assertEqual(self.render_jinja('{% adgeletti_go %}'), tags.error(u'{% adgeletti_go %} was run without an {% ad ... %}'))
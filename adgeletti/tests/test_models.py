@@ -1,7 +1,9 @@
 import mock
 from django.utils.unittest import TestCase
 from django.conf import settings
-from adgeletti.models import Size, AdSlot
+from django.core.exceptions import ValidationError
+from adgeletti.models import Size, AdSlot, AdPosition, AdPositionLookup, AdRefresh
+from adgeletti.tests import AdTestCase
 
 
 class SizeTestCase(TestCase):
@@ -28,3 +30,62 @@ class AdSlotTestCase(TestCase):
         expected = '%s/%s' % (settings.ADGELETTI_DFP_NETWORK_ID, 'UNIT_ID')
         self.assertEqual(string, expected)
 
+
+
+class AdPositionLookupTestCase(AdTestCase):
+    def lookup(self):
+        return AdPositionLookup.objects.get(position=self.pos)
+
+    def test_created(self):
+        lookup = self.lookup()
+        self.assertEqual((lookup.site_id, lookup.label, lookup.breakpoint), (self.site.pk, 'SLOT', 'A'))
+        self.assertEqual(lookup.ad_unit_id(), '%s/ADUNIT' % settings.ADGELETTI_DFP_NETWORK_ID)
+        self.assertEqual(lookup.sizes, '300x250')
+        self.assertEqual(lookup.size_list(), [[300, 250]])
+
+    def test_slot_changed(self):
+        self.slot.label = 'OTHER'
+        self.slot.ad_unit = 'UNIT'
+        self.slot.save()
+        self.assertEqual((self.lookup().label, self.lookup().ad_unit), ('OTHER', 'UNIT'))
+
+    def test_sizes_changed(self):
+        self.pos.sizes.add(Size.objects.create(width=728, height=90))
+        self.assertItemsEqual(self.lookup().size_list(), [[300, 250], [728, 90]])
+
+        self.size.width = 320
+        self.size.save()
+        self.assertItemsEqual(self.lookup().size_list(), [[320, 250], [728, 90]])
+
+        self.size.adposition_set.clear()
+        self.assertEqual(self.lookup().size_list(), [[728, 90]])
+
+    def test_size_deleted(self):
+        self.size.delete()
+        self.assertEqual(self.lookup().size_list(), [])
+
+    def test_refresh(self):
+        self.assertIsNone(self.lookup().refresh_config())
+        refresh = AdRefresh.objects.create(position=self.pos, interval=30)
+        self.assertEqual(self.lookup().refresh_config(), [30, 0])
+        refresh.max_refreshes = 3
+        refresh.save()
+        self.assertEqual(self.lookup().refresh_config(), [30, 3])
+
+    def test_refresh_min_interval(self):
+        self.assertRaises(ValidationError, AdRefresh(position=self.pos, interval=0).full_clean)
+        AdRefresh(position=self.pos, interval=30).full_clean()
+
+    def test_position_deleted(self):
+        self.pos.delete()
+        self.assertFalse(AdPositionLookup.objects.exists())
+
+    def test_rebuild(self):
+        AdPositionLookup.objects.all().delete()
+        AdPositionLookup.objects.rebuild()
+        self.assertEqual(self.lookup().sizes, '300x250')
+
+    def test_for_page_query_count(self):
+        with self.assertNumQueries(1):
+            lookups = list(AdPositionLookup.objects.for_page(self.site, ['SLOT'], ['A', 'B']))
+            self.assertEqual([lookup.size_list() for lookup in lookups], [[[300, 250]]])
@@ -0,0 +1,57 @@
+import json
+import mock
+from adgeletti.preload import preload
+from adgeletti.templatetags import adgeletti_tags as tags
+from adgeletti.tests import AdTestCase
+from django import template
+from django.test.utils import override_settings
+
+
+class PreloadTestCase(AdTestCase):
+    def setUp(self):
+        super(PreloadTestCase, self).setUp()
+        self.position = {
+            'breakpoint': 'A',
+            'ad_unit_id': self.slot.ad_unit_id(),
+            'sizes': [[300, 250]],
+            'div_id': tags.AdNode.div_id('SLOT', 'A'),
+        }
+
+    def render(self, source, preloaded):
+        tpl = template.Template('{% load adgeletti_tags %}' + source)
+        return tpl.render(template.Context({'request': self.request, tags.PRELOADED: preloaded}))
+
+    def test_preload(self):
+        preloaded = preload(self.request, ['SLOT', 'OTHER'], ['A', 'B'])
+        self.assertIs(preloaded.site, self.site)
+        self.assertEqual(preloaded.positions, {
+            ('SLOT', 'A'): self.position,
+            ('SLOT', 'B'): None,
+            ('OTHER', 'A'): None,
+            ('OTHER', 'B'): None,
+        })
+
+    @override_settings(ADGELETTI_BREAKPOINTS=[('A', ''), ('B', '')])
+    def test_preload_all_breakpoints(self):
+        preloaded = preload(self.request, ['SLOT'])
+        self.assertEqual(sorted(preloaded.positions), [('SLOT', 'A'), ('SLOT', 'B')])
+
+    def test_render(self):
+        preloaded = preload(self.request, ['SLOT'], ['A', 'B'])
+        with self.assertNumQueries(0):
+            result = self.render('{% ad SLOT A B %}{% adgeletti_go %}', preloaded)
+        self.assertIn("Adgeletti.position('%s');\n" % json.dumps(self.position), result)
+
+    @override_settings(ADGELETTI_STREAMING=True)
+    def test_render_streaming(self):
+        preloaded = preload(self.request, ['SLOT'], ['A'])
+        with self.assertNumQueries(0):
+            result = self.render('{% ad SLOT A %}{% adgeletti_go %}', preloaded)
+        self.assertIn("Adgeletti.position('%s');\n" % json.dumps(self.position), result)
+
+    def test_render_not_preloaded(self):
+        preloaded = preload(self.request, ['OTHER'], ['A'])
+        with mock.patch('adgeletti.preload.get_positions', wraps=tags.get_positions) as get_positions:
+            result = self.render('{% ad SLOT A %}{% ad OTHER A %}{% adgeletti_go %}', preloaded)
+        get_positions.assert_called_once_with(self.site, {'SLOT': {'A': tags.AdNode.div_id('SLOT', 'A')}})
+        self.assertIn("Adgeletti.position('%s');\n" % json.dumps(self.position), result)
@@ -1,9 +1,17 @@
+import cStringIO
 import json
 import mock
+from adgeletti import signals
+from adgeletti.middleware import PlaceholderMiddleware
 from adgeletti.models import Size, AdSlot, AdPosition
 from adgeletti.templatetags import adgeletti_tags as tags
+from adgeletti.tests import AdTestCase
 from django import template
+from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import connection
+from django.http import HttpResponse
+from django.test.utils import override_settings
 from django.utils.unittest import TestCase
 
 
@@ -16,6 +24,33 @@ class ErrorTestCase(TestCase):
         self.assertEqual(error, '<!-- BAR -->\n')
 
 
+class GetSiteTestCase(TestCase):
+    def setUp(self):
+        self.site = mock.Mock(pk=1)
+
+    @mock.patch('adgeletti.templatetags.adgeletti_tags.Site')
+    def test_request_site(self, site):
+        request = mock.Mock(site=self.site)
+        self.assertIs(tags.get_site(template.Context({'request': request})), self.site)
+        self.assertFalse(site.objects.get_current.called)
+
+    @mock.patch('adgeletti.templatetags.adgeletti_tags.Site')
+    def test_memoized_on_request(self, site):
+        site.objects.get_current.return_value = self.site
+        request = mock.Mock(spec=['path'])
+        for i in range(2):
+            self.assertIs(tags.get_site(template.Context({'request': request})), self.site)
+        self.assertEqual(site.objects.get_current.call_count, 1)
+
+    @mock.patch('adgeletti.templatetags.adgeletti_tags.Site')
+    def test_memoized_on_render_context(self, site):
+        site.objects.get_current.return_value = self.site
+        context = template.Context({})
+        for i in range(2):
+            self.assertIs(tags.get_site(context), self.site)
+        self.assertEqual(site.objects.get_current.call_count, 1)
+
+
 class ParseAdTestCase(TestCase):
     def test_parse_ad(self):
         token = mock.Mock()
@@ -29,7 +64,35 @@ class ParseAdTestCase(TestCase):
         token.split_contents = mock.Mock(return_value=['ad', 'SLOT'])
         with self.assertRaises(template.TemplateSyntaxError) as exc:
             tags.parse_ad(None, token)
-        self.assertEqual(str(exc.exception), u'usage: {% ad SLOT BREAKPOINT [BREAKPOINT ...] %}')
+        self.assertEqual(str(exc.exception), u'usage: {% ad SLOT BREAKPOINT [BREAKPOINT ...] [lazy=false] %}')
+
+    def test_parse_ad_bad_args_variable_slot(self):
+        for args in (['ad', 'slot=foo'], ['ad', 'slot=foo', 'lazy=false']):
+            token = mock.Mock()
+            token.split_contents = mock.Mock(return_value=args)
+            with self.assertRaises(template.TemplateSyntaxError) as exc:
+                tags.parse_ad(template.Parser([]), token)
+            self.assertEqual(str(exc.exception), u'usage: {% ad SLOT BREAKPOINT [BREAKPOINT ...] [lazy=false] %}')
+
+    def test_parse_ad_lazy(self):
+        token = mock.Mock()
+        token.split_contents = mock.Mock(return_value=['ad', 'SLOT', 'BREAKPOINT', 'lazy=false'])
+        node = tags.parse_ad(None, token)
+        self.assertListEqual(node.breakpoints, ['BREAKPOINT'])
+        self.assertFalse(node.lazy)
+
+    def test_parse_ad_variable_slot(self):
+        token = mock.Mock()
+        token.split_contents = mock.Mock(return_value=['ad', 'slot=item.label|upper', 'BREAKPOINT'])
+        node = tags.parse_ad(template.Parser([]), token)
+        self.assertIsInstance(node.slot, template.FilterExpression)
+        self.assertIsNone(node.divs)
+
+    def test_parse_ad_bad_option(self):
+        token = mock.Mock()
+        token.split_contents = mock.Mock(return_value=['ad', 'SLOT', 'BREAKPOINT', 'lazy=no'])
+        with self.assertRaises(template.TemplateSyntaxError):
+            tags.parse_ad(None, token)
 
 
 class AdNodeTestCase(TestCase):
@@ -55,6 +118,10 @@ class AdNodeTestCase(TestCase):
         div = tags.AdNode.build_div('FOO')
         self.assertEqual(div, '<div class="adgeletti-ad-div" id="FOO" style="display:none"></div>\n')
 
+    def test_build_div_eager(self):
+        div = tags.AdNode.build_div('FOO', lazy=False)
+        self.assertEqual(div, '<div class="adgeletti-ad-div" id="FOO" style="display:none" data-adgeletti-lazy="false"></div>\n')
+
     def test_render(self):
         c = template.Context({})
         result = self.node.render(c)
@@ -73,6 +140,63 @@ class AdNodeTestCase(TestCase):
         result = self.node.render(c)
         self.assertEqual(result, tags.error('{% ad ... %} used after {% adgeletti_go %} used'))
 
+    def test_divs_built_once(self):
+        with mock.patch.object(tags.AdNode, 'clean_value') as clean_value:
+            self.node.render(template.Context({}))
+        self.assertFalse(clean_value.called)
+
+    def test_render_variable_slot(self):
+        tpl = template.Template('{% load adgeletti_tags %}{% for label in labels %}{% ad slot=label A %}{% endfor %}')
+        tags.AdNode._built.clear()
+        with mock.patch.object(tags.AdNode, 'clean_value', wraps=tags.AdNode.clean_value) as clean_value:
+            result = tpl.render(template.Context({'labels': ['SLOT1', 'SLOT2', 'SLOT1', '', None]}))
+            tpl.render(template.Context({'labels': ['SLOT1']}))
+        self.assertEqual(result, ''.join([
+            tags.AdNode.build_div(tags.AdNode.div_id('SLOT1', 'A')),
+            tags.AdNode.build_div(tags.AdNode.div_id('SLOT2', 'A')),
+        ]))
+        # Once for each slot, across renders
+        self.assertEqual(clean_value.call_count, 2)
+
+
+class CompactPayloadTestCase(TestCase):
+    def setUp(self):
+        network = settings.ADGELETTI_DFP_NETWORK_ID
+        self.positions = [
+            {'breakpoint': 'A', 'ad_unit_id': '%s/UNIT1' % network, 'sizes': [[300, 250], [728, 90]], 'div_id': tags.AdNode.div_id('SLOT1', 'A')},
+            {'breakpoint': 'B', 'ad_unit_id': '%s/UNIT1' % network, 'sizes': [[728, 90]], 'div_id': tags.AdNode.div_id('SLOT1', 'B')},
+            {'breakpoint': 'A', 'ad_unit_id': '%s/UNIT2' % network, 'sizes': [[300, 250]], 'div_id': tags.AdNode.div_id('SLOT2', 'A')},
+        ]
+
+    def test_compact_payload(self):
+        self.assertEqual(tags.compact_payload(self.positions), [
+            tags.PAYLOAD_VERSION,
+            settings.ADGELETTI_DFP_NETWORK_ID,
+            ['A', 'B'],
+            [[300, 250], [728, 90]],
+            [[0, 'UNIT1', 'SLOT1-A', [0, 1]], [1, 'UNIT1', 'SLOT1-B', [1]], [0, 'UNIT2', 'SLOT2-A', [0]]],
+        ])
+
+    def test_compact_payload_refresh(self):
+        self.positions[1]['refresh'] = [30, 0]
+        self.assertEqual(tags.compact_payload(self.positions)[4][:2], [[0, 'UNIT1', 'SLOT1-A', [0, 1]], [1, 'UNIT1', 'SLOT1-B', [1], [30, 0]]])
+
+    def test_compact_payload_other_network(self):
+        self.positions[0]['ad_unit_id'] = 'OTHER/UNIT1'
+        payload = tags.compact_payload(self.positions)
+        self.assertEqual(payload[1], '')
+        self.assertEqual([pos[1] for pos in payload[4]], ['OTHER/UNIT1', '%s/UNIT1' % settings.ADGELETTI_DFP_NETWORK_ID, '%s/UNIT2' % settings.ADGELETTI_DFP_NETWORK_ID])
+
+    @override_settings(ADGELETTI_COMPACT_PAYLOAD=True)
+    def test_write_positions(self):
+        self.positions[0]['ad_unit_id'] += '</script>'
+        buf = cStringIO.StringIO()
+        tags.write_positions(buf, self.positions)
+        content = buf.getvalue()
+        self.assertTrue(content.startswith('Adgeletti.load([%d,' % tags.PAYLOAD_VERSION))
+        self.assertNotIn('</script>', content)
+        self.assertEqual(json.loads(content[len('Adgeletti.load('):-len(');\n')]), tags.compact_payload(self.positions))
+
 
 class ParseAdgelettiGoTestCase(TestCase):
     def test_parse_adgeletti_go(self):
@@ -113,6 +237,15 @@ class AdBlockTestCase(TestCase):
         result = self.block.render(context)
         self.assertEqual(result, tags.error('{% adgeletti_go %} called more than once'))
 
+    def test_options(self):
+        self.assertEqual(tags.AdBlock.options(), {})
+        with override_settings(ADGELETTI_SINGLE_REQUEST=True):
+            self.assertEqual(tags.AdBlock.options(), {'single_request': True})
+        with override_settings(ADGELETTI_LAZY_LOAD=True, ADGELETTI_LAZY_ROOT_MARGIN='50px'):
+            self.assertEqual(tags.AdBlock.options(), {'lazy_load': True, 'lazy_root_margin': '50px'})
+        with override_settings(ADGELETTI_BREAKPOINTS=['A', ('B', '(min-width: 1024px)')]):
+            self.assertEqual(tags.AdBlock.options(), {'breakpoints': {'B': '(min-width: 1024px)'}})
+
     def test_render_no_positions(self):
         result = self.block.render(self.context)
         self.assertEqual(result, tags.error("No ad positions exist for the slots in the page (slots: ['SLOT1', 'SLOT2'])"))
@@ -157,3 +290,239 @@ class AdBlockTestCase(TestCase):
         for pos in positions:
             self.assertIn('Adgeletti.position(\'%s\');' % json.dumps(pos), result)
 
+
+
+class AdBlockPayloadCacheTestCase(AdTestCase):
+    def render(self):
+        context = template.Context({})
+        tags.AdNode('SLOT', ['A']).render(context)
+        with mock.patch.object(tags.Site.objects, 'get_current', return_value=self.site):
+            return tags.AdBlock().render(context)
+
+    def test_memoized(self):
+        content = self.render()
+        with mock.patch.object(tags.AdBlock, 'render_positions') as render_positions:
+            self.assertEqual(self.render(), content)
+            self.assertFalse(render_positions.called)
+
+    @override_settings(ADGELETTI_SINGLE_REQUEST=True)
+    def test_options(self):
+        self.assertIn('Adgeletti.configure({"single_request": true});\n', self.render())
+
+    @override_settings(ADGELETTI_GPT_LOADER=True)
+    def test_gpt_loader(self):
+        self.assertTrue(self.render().startswith('<script async src="%s"></script>\n<script type="text/javascript">\n' % tags.AdBlock.GPT_URL))
+
+    def test_invalidated(self):
+        self.render()
+        self.slot.ad_unit = 'OTHER'
+        self.slot.save()
+        self.assertIn('/OTHER"', self.render())
+
+
+class DeferredTestCase(AdTestCase):
+    slot_label = 'SLOT-1'
+
+    def render(self):
+        tpl = template.Template('{% load adgeletti_tags %}{% ad SLOT-1 A B %}<p></p>{% adgeletti_go %}')
+        return tpl.render(template.Context({'request': self.request}))
+
+    def respond(self, content):
+        response = HttpResponse(content)
+        response['Content-Length'] = str(len(response.content))
+        return PlaceholderMiddleware().process_response(self.request, response)
+
+    def test_placeholder(self):
+        with override_settings(ADGELETTI_DEFERRED=True):
+            result = self.render()
+        self.assertTrue(result.endswith('<p></p><!--adgeletti:{"SLOT\\u002d1":["A","B"]}-->\n'))
+
+    def test_filled(self):
+        expected = self.render()
+        with override_settings(ADGELETTI_DEFERRED=True):
+            page = self.render()
+        response = self.respond(page)
+        self.assertEqual(response.content, expected)
+        self.assertEqual(response['Content-Length'], str(len(expected)))
+
+    def test_current_configuration(self):
+        with override_settings(ADGELETTI_DEFERRED=True):
+            page = self.render()
+        self.slot.ad_unit = 'OTHER'
+        self.slot.save()
+        self.assertIn('/OTHER"', self.respond(page).content)
+
+    def test_untouched(self):
+        response = HttpResponse('<p></p>')
+        response['Content-Encoding'] = 'gzip'
+        response.content = '<!--adgeletti:{}-->'
+        self.assertEqual(PlaceholderMiddleware().process_response(self.request, response).content, '<!--adgeletti:{}-->')
+
+    def test_iterator_untouched(self):
+        response = HttpResponse(iter(['a,b\n', '<!--adgeletti:{}-->\n']), content_type='text/csv')
+        response = PlaceholderMiddleware().process_response(self.request, response)
+        self.assertEqual(response.content, 'a,b\n<!--adgeletti:{}-->\n')
+
+        response = HttpResponse(iter(['<p></p>', '<!--adgeletti:{}-->']))
+        response = PlaceholderMiddleware().process_response(self.request, response)
+        self.assertEqual(response.content, '<p></p><!--adgeletti:{}-->')
+
+    def test_not_html_untouched(self):
+        response = HttpResponse('<!--adgeletti:{}-->', content_type='text/plain')
+        self.assertEqual(PlaceholderMiddleware().process_response(self.request, response).content, '<!--adgeletti:{}-->')
+
+
+@override_settings(ADGELETTI_CONFIG_CACHE=False)
+class AdBlockQueryCountTestCase(AdTestCase):
+    def setUp(self):
+        super(AdBlockQueryCountTestCase, self).setUp()
+        self.sizes = [Size.objects.create(width=w, height=h) for w, h in [(320, 50), (728, 90)]]
+
+    def create_slots(self, count, breakpoints, prefix='SLOT'):
+        labels = []
+        for i in range(count):
+            slot = AdSlot.objects.create(label='%s%d' % (prefix, i), ad_unit='ADUNIT%d' % i, site=self.site)
+            for breakpoint in breakpoints:
+                pos = AdPosition.objects.create(slot=slot, breakpoint=breakpoint)
+                pos.sizes.add(*self.sizes)
+            labels.append(slot.label)
+        return labels
+
+    def render(self, labels, breakpoints):
+        source = ''.join('{%% ad %s %s %%}' % (label, ' '.join(breakpoints)) for label in labels)
+        tpl = template.Template('{% load adgeletti_tags %}' + source + '{% adgeletti_go %}')
+        return tpl.render(template.Context({'request': mock.Mock(site=self.site)}))
+
+    def test_query_count(self):
+        # The number of queries doesn't grow with the number of positions
+        labels = self.create_slots(1, ['A'])
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render(labels, ['A']).count('Adgeletti.position('), 1)
+
+        labels = self.create_slots(12, ['A', 'B', 'C'], prefix='MANY')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.render(labels, ['A', 'B', 'C']).count('Adgeletti.position('), 36)
+
+    def test_get_positions(self):
+        labels = self.create_slots(2, ['A', 'B'])
+        other = Site.objects.create(name='OTHER', domain='example.org')
+        AdPosition.objects.create(slot=AdSlot.objects.create(label='SLOT0', ad_unit='X', site=other), breakpoint='A')
+
+        with self.assertNumQueries(1):
+            positions = tags.get_positions(self.site, {labels[0]: {'A': 'div'}})
+        self.assertEqual(len(positions), 1)
+        self.assertEqual(positions[0]['ad_unit_id'], '%s/ADUNIT0' % settings.ADGELETTI_DFP_NETWORK_ID)
+        self.assertItemsEqual(positions[0]['sizes'], [[320, 50], [728, 90]])
+
+
+@override_settings(ADGELETTI_STREAMING=True)
+class StreamingTestCase(AdTestCase):
+    def render(self, source):
+        tpl = template.Template('{% load adgeletti_tags %}' + source)
+        return tpl.render(template.Context({'request': self.request}))
+
+    def test_render(self):
+        result = self.render('{% ad SLOT A B %}<p></p>{% adgeletti_go %}')
+        position = {'breakpoint': 'A', 'ad_unit_id': self.slot.ad_unit_id(), 'sizes': [[300, 250]], 'div_id': tags.AdNode.div_id('SLOT', 'A')}
+        self.assertEqual(result, ''.join([
+            tags.AdNode.build_div(tags.AdNode.div_id('SLOT', 'A')),
+            tags.AdNode.build_div(tags.AdNode.div_id('SLOT', 'B')),
+            '<script type="text/javascript">\n',
+            'Adgeletti.position(\'%s\');\n' % json.dumps(position),
+            '</script>\n',
+            '<p></p>',
+        ]))
+
+    @override_settings(ADGELETTI_PRUNE_BREAKPOINTS=True, ADGELETTI_BREAKPOINTS=[('A', '(max-width: 767px)'), ('B', '(min-width: 768px)')])
+    def test_render_pruned(self):
+        request = mock.Mock(site=self.site, META={'HTTP_SEC_CH_VIEWPORT_WIDTH': '375'})
+        tpl = template.Template('{% load adgeletti_tags %}{% ad SLOT A B %}{% adgeletti_go %}')
+        result = tpl.render(template.Context({'request': request}))
+        self.assertTrue(result.startswith(tags.AdNode.build_div(tags.AdNode.div_id('SLOT', 'A')) + '<script'))
+        self.assertNotIn(tags.AdNode.div_id('SLOT', 'B'), result)
+
+    @override_settings(ADGELETTI_SINGLE_REQUEST=True)
+    def test_render_bootstrap(self):
+        result = self.render('{% ad SLOT A %}<p></p>{% adgeletti_go %}')
+        self.assertTrue(result.endswith('<p></p><script type="text/javascript">\nAdgeletti.configure({"single_request": true});\n</script>\n'))
+
+    @override_settings(ADGELETTI_GPT_LOADER=True, ADGELETTI_GPT_URL='/gpt.js?a&b')
+    def test_render_bootstrap_gpt_loader(self):
+        result = self.render('{% ad SLOT A %}<p></p>{% adgeletti_go %}')
+        self.assertTrue(result.endswith('<p></p><script async src="/gpt.js?a&amp;b"></script>\n'))
+
+    @override_settings(ADGELETTI_CONFIG_CACHE=False)
+    def test_render_uncached(self):
+        for label in ('SLOT2', 'SLOT3'):
+            slot = AdSlot.objects.create(label=label, ad_unit='ADUNIT', site=self.site)
+            AdPosition.objects.create(slot=slot, breakpoint='A')
+        # The configuration is loaded once, rather than for each tag
+        with self.assertNumQueries(1):
+            result = self.render('{% ad SLOT A %}{% ad SLOT2 A %}{% ad SLOT3 A %}{% adgeletti_go %}')
+        self.assertEqual(result.count('Adgeletti.position('), 3)
+
+    def test_render_no_positions(self):
+        result = self.render('{% ad OTHER A %}{% adgeletti_go %}')
+        self.assertTrue(result.endswith(tags.error("No ad positions exist for the slots in the page (slots: [u'OTHER'])")))
+
+
+class InstrumentationTestCase(AdTestCase):
+    def setUp(self):
+        super(InstrumentationTestCase, self).setUp()
+        self.received = []
+        signals.ad_rendered.connect(self.receiver)
+        signals.block_rendered.connect(self.receiver)
+
+    def tearDown(self):
+        signals.ad_rendered.disconnect(self.receiver)
+        signals.block_rendered.disconnect(self.receiver)
+
+    def receiver(self, sender, signal, **kwargs):
+        self.received.append((sender, kwargs))
+
+    def render(self):
+        tpl = template.Template('{% load adgeletti_tags %}{% ad SLOT A %}{% adgeletti_go %}')
+        return tpl.render(template.Context({'request': self.request}))
+
+    def test_signals(self):
+        content = self.render()
+        self.assertEqual([sender for sender, kwargs in self.received], [tags.AdNode, tags.AdBlock])
+
+        kwargs = self.received[0][1]
+        self.assertEqual(kwargs['slot'], 'SLOT')
+        self.assertEqual(kwargs['queries'], 0)
+
+        kwargs = self.received[1][1]
+        self.assertEqual(kwargs['positions'], 1)
+        self.assertFalse(kwargs['cache_hit'])
+        self.assertEqual(kwargs['queries'], 1)
+        self.assertEqual(kwargs['bytes'], len(content) - len(tags.AdNode.build_div(tags.AdNode.div_id('SLOT', 'A'))))
+        self.assertTrue(kwargs['duration'] >= 0)
+
+        self.received = []
+        self.render()
+        kwargs = self.received[1][1]
+        self.assertTrue(kwargs['cache_hit'])
+        self.assertEqual(kwargs['queries'], 0)
+
+    @override_settings(DEBUG=False)
+    def test_query_log_discarded(self):
+        # Queries are only logged while rendering, and aren't kept
+        self.assertFalse(connection.use_debug_cursor)
+        count = len(connection.queries)
+        self.render()
+        self.assertEqual(self.received[1][1]['queries'], 1)
+        self.assertEqual(len(connection.queries), count)
+
+    @override_settings(DEBUG=True)
+    def test_query_log_kept_in_debug(self):
+        count = len(connection.queries)
+        self.render()
+        self.assertEqual(len(connection.queries), count + 1)
+
+    @mock.patch('adgeletti.templatetags.adgeletti_tags.instrument')
+    def test_disabled(self, instrument):
+        self.tearDown()
+        self.render()
+        self.assertFalse(instrument.called)
+        self.assertEqual(self.received, [])
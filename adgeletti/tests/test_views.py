@@ -0,0 +1,56 @@
+import json
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from adgeletti import cache
+from adgeletti.templatetags import adgeletti_tags as tags
+from adgeletti.tests import AdTestCase
+
+
+class PositionsViewTestCase(AdTestCase):
+    breakpoint = 'mobile'
+
+    def setUp(self):
+        super(PositionsViewTestCase, self).setUp()
+        self.url = reverse('adgeletti_positions')
+
+    def create_site(self):
+        # The view serves the current site
+        return Site.objects.get_current()
+
+    def test_positions(self):
+        response = self.client.get(self.url, {'slots': 'SLOT,OTHER'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(response.content), [{
+            'breakpoint': 'mobile',
+            'ad_unit_id': '%s/ADUNIT' % settings.ADGELETTI_DFP_NETWORK_ID,
+            'sizes': [[300, 250]],
+            'div_id': tags.AdNode.div_id('SLOT', 'mobile'),
+        }])
+        self.assertIn('max-age=3600', response['Cache-Control'])
+
+    def test_breakpoints(self):
+        response = self.client.get(self.url, {'slots': 'SLOT', 'breakpoints': 'wide'})
+        self.assertEqual(json.loads(response.content), [])
+
+    def test_compact(self):
+        response = self.client.get(self.url, {'slots': 'SLOT', 'format': 'compact'})
+        self.assertEqual(json.loads(response.content)[4], [[0, 'ADUNIT', 'SLOT-mobile', [0]]])
+
+    def test_no_slots(self):
+        self.assertEqual(self.client.get(self.url).status_code, 400)
+
+    def test_not_modified(self):
+        etag = self.client.get(self.url, {'slots': 'SLOT'})['ETag']
+        self.assertTrue(etag.startswith('"'))
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url, {'slots': 'SLOT'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.slot.ad_unit = 'OTHER'
+        self.slot.save()
+        cache.flush_invalidation()
+        response = self.client.get(self.url, {'slots': 'SLOT'}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
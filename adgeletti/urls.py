@@ -0,0 +1,6 @@
+from django.conf.urls import patterns, url
+
+
+urlpatterns = patterns('adgeletti.views',
+    url(r'^positions/$', 'positions', name='adgeletti_positions'),
+)
@@ -0,0 +1,63 @@
+import json
+import hashlib
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition, require_GET
+
+from adgeletti import cache
+from adgeletti.conf import get_breakpoints
+from adgeletti.templatetags.adgeletti_tags import AdNode, compact_payload, get_positions, get_request_site
+
+
+def parse_list(request, name):
+    """Returns the values of a query parameter, given either as a comma
+    separated list, or repeatedly.
+    """
+    values = []
+    for value in request.GET.getlist(name):
+        values.extend(v.strip() for v in value.split(u',') if v.strip())
+    return sorted(set(values))
+
+
+def positions_etag(request):
+    """Returns the ETag of the response of ``positions``, which only depends on
+    the request's site, slots, breakpoints and format, and on the generation
+    of the ad configuration (see ``adgeletti.cache``).
+    """
+    key = json.dumps([
+        get_request_site(request).pk,
+        cache.get_generation(),
+        parse_list(request, 'slots'),
+        parse_list(request, 'breakpoints'),
+        request.GET.get('format', u''),
+    ])
+    return hashlib.sha1(key).hexdigest()
+
+
+@require_GET
+@condition(etag_func=positions_etag)
+def positions(request):
+    """Returns the positions of the site's ads for the given slots
+    ("slots") and breakpoints ("breakpoints", by default all of them), as a
+    JSON array of the data of each position, as passed to `Adgeletti.position`
+    (see ``get_positions``), or, with "format=compact", in the compact payload
+    format passed to `Adgeletti.load` (see ``compact_payload``).
+
+    Responses can be cached for ``settings.ADGELETTI_CONFIG_MAX_AGE`` seconds
+    (3600 by default), and carry an ETag, for conditional requests.
+    """
+    slots = parse_list(request, 'slots')
+    if not slots:
+        return HttpResponseBadRequest(u'No slots given.', content_type='text/plain')
+    breakpoints = parse_list(request, 'breakpoints') or [name for name, media_query in get_breakpoints()]
+
+    ads = dict((slot, dict((bp, AdNode.div_id(slot, bp)) for bp in breakpoints)) for slot in slots)
+    data = get_positions(get_request_site(request), ads)
+    if request.GET.get('format') == 'compact':
+        data = compact_payload(data)
+
+    response = HttpResponse(json.dumps(data), content_type='application/json')
+    patch_cache_control(response, public=True, max_age=getattr(settings, 'ADGELETTI_CONFIG_MAX_AGE', 3600))
+    return response
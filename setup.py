@@ -24,4 +24,7 @@ setup(
         'Topic :: Utilities'
     ],
     packages=find_packages(),
+    extras_require={
+        'jinja2': ['Jinja2'],
+    },
 )